@@ -187,51 +187,294 @@ if __name__ == '__main__':
 
 
 def app(work_path, project_name):
-    return f"""import os
+    return f"""import json
+import time
+from flask import Flask
+from flask import request
+from loguru import logger
+from {work_path}.{project_name}.settings import n_class_file
+from {work_path}.{project_name}.serving import load_model
+from {work_path}.{project_name}.serving import configure_device
+from {work_path}.{project_name}.serving import Model_Reloader
+from {work_path}.{project_name}.utils import Predict_Image
+from {work_path}.{project_name}.utils import Batch_Predict
+from {work_path}.{project_name}.utils import Result_Cache
+from {work_path}.{project_name}.utils import Cascade_Predict
+from {work_path}.{project_name}.utils import Request_Shed
+from {work_path}.{project_name}.utils import metrics
+from {work_path}.{project_name}.api_request import client_deadline
+from {work_path}.{project_name}.api_request import request_image
+from {work_path}.{project_name}.api_request import request_images
+
+configure_device()
+
+app = Flask(__name__)
+model = load_model()
+batch_predict = Batch_Predict(model, num_classes=n_class_file)
+result_cache = Result_Cache()
+model_reloader = Model_Reloader(batch_predict, result_cache)
+metrics.gauge('captcha_queue_depth', '等待批处理和/batch正在预测的图片数', batch_predict.depth)
+
+
+@app.route("/", methods=['POST'])
+def captcha_predict():
+    return_dict = {{'return_code': '200', 'return_info': '处理成功', 'result': False, 'recognition_rate': 0, 'time': None}}
+    start_time = time.time()
+    deadline = client_deadline(request)
+    status = 200
+    try:
+        image = request_image(request)
+        if image:
+            result, recognition_rate = result_cache.get_or_predict(
+                image, lambda image: batch_predict.predict_bytes(image, deadline))
+            times = time.time() - start_time
+            return_dict['time'] = str(times)
+            return_dict['result'] = str(result)
+            return_dict['recognition_rate'] = str(recognition_rate)
+        else:
+            return_dict['return_code'] = '5004'
+            return_dict['return_info'] = '参数错误，没有img属性'
+    except Request_Shed as e:
+        status = 503
+        return_dict['return_code'] = e.return_code
+        return_dict['return_info'] = e.return_info
+    except Exception as e:
+        return_dict['result'] = str(e)
+        return_dict['return_info'] = '模型识别错误'
+    metrics.request(return_dict['return_code'], time.time() - start_time)
+    logger.debug(return_dict)
+    return json.dumps(return_dict, ensure_ascii=False), status
+
+
+@app.route("/batch", methods=['POST'])
+def captcha_predict_batch():
+    # 接收的格式见api_request.request_images
+    return_dict = {{'return_code': '200', 'return_info': '处理成功', 'result': [], 'time': None}}
+    start_time = time.time()
+    deadline = client_deadline(request)
+    status = 200
+    image_list, encoded = request_images(request)
+    if image_list and isinstance(image_list, list):
+        try:
+            results, times = Predict_Image(image=image_list, num_classes=n_class_file).api_batch(
+                batch_predict, result_cache, encoded=encoded, deadline=deadline)
+            return_dict['time'] = str(times)
+            return_dict['result'] = [{{'result': str(result), 'recognition_rate': str(recognition_rate)}} for
+                                     result, recognition_rate in results]
+        except Request_Shed as e:
+            status = 503
+            return_dict['return_code'] = e.return_code
+            return_dict['return_info'] = e.return_info
+        except Exception as e:
+            return_dict['result'] = str(e)
+            return_dict['return_info'] = '模型识别错误'
+    else:
+        return_dict['return_code'] = '5004'
+        return_dict['return_info'] = '参数错误，没有img属性'
+    metrics.request(return_dict['return_code'], time.time() - start_time)
+    logger.debug(return_dict)
+    return json.dumps(return_dict, ensure_ascii=False), status
+
+
+@app.route("/stats", methods=['GET'])
+def captcha_stats():
+    # 动态批处理、识别结果缓存、模型热更新和级联预测的统计
+    cascade = batch_predict.model.report() if isinstance(batch_predict.model, Cascade_Predict) else None
+    return json.dumps({{'batch': batch_predict.report(), 'cache': result_cache.report(),
+                       'reload': model_reloader.report(), 'cascade': cascade}}, ensure_ascii=False)
+
+
+@app.route("/metrics", methods=['GET'])
+def captcha_metrics():
+    # Prometheus文本格式的指标,每个进程单独统计
+    return metrics.render(), 200, {{'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}}
+
+
+@app.route("/reload", methods=['POST'])
+def captcha_reload():
+    # 立即加载模型目录里最新的模型并替换,只接受本机的请求
+    return_dict = {{'return_code': '200', 'return_info': '处理成功', 'time': None}}
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return_dict['return_code'] = '5003'
+        return_dict['return_info'] = '只能在本机调用'
+        return json.dumps(return_dict, ensure_ascii=False)
+    try:
+        return_dict['time'] = str(model_reloader.reload())
+    except Exception as e:
+        return_dict['return_code'] = '5002'
+        return_dict['return_info'] = f'模型热更新失败:{{e}}'
+    logger.debug(return_dict)
+    return json.dumps(return_dict, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5006, debug=True)
+
+"""
+
+
+def api_request(work_path, project_name):
+    return f"""# 三个后端(app.py、multi_app.py、asgi_app.py)共用的请求解析,保证三个入口接收的格式一致
+# Flask的函数接收flask.request;asgi_app.py不依赖Flask,用body_image和body_images解析请求体
 import json
+import base64
+from urllib.parse import parse_qs
+from email.parser import BytesParser
+from {work_path}.{project_name}.settings import REQUEST_TIMEOUT
+from {work_path}.{project_name}.utils import request_deadline
+from {work_path}.{project_name}.utils import metrics
+
+
+def timeout_deadline(timeout):
+    # 客户端可以用timeout查询参数(秒)指定超时时间,没有或者不是数字时为REQUEST_TIMEOUT
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        timeout = REQUEST_TIMEOUT
+    return request_deadline(timeout)
+
+
+def decode_base64(base64_str):
+    with metrics.timer('base64_decode'):
+        return base64.b64decode(base64_str)
+
+
+def json_images(data):
+    # /batch的json可以是数组,也可以是{{"img": [...]}}
+    if isinstance(data, dict):
+        return data.get('img')
+    return data
+
+
+def client_deadline(request):
+    return timeout_deadline(request.args.get('timeout'))
+
+
+def request_image(request):
+    # application/octet-stream直接读取请求体,multipart/form-data读取img文件,其他读取base64的img表单字段
+    if request.mimetype == 'application/octet-stream':
+        return request.get_data(cache=False)
+    if request.mimetype == 'multipart/form-data' and 'img' in request.files:
+        return request.files['img'].read()
+    base64_str = request.form.get('img')
+    if base64_str:
+        return decode_base64(base64_str)
+    return None
+
+
+def request_images(request):
+    # 接收json数组(或{{"img": [...]}})或者多个img字段的表单,每一项都是base64后的图片,也可以上传多个img文件
+    # 返回(图片列表, 是否为base64)
+    if request.is_json:
+        return json_images(request.get_json(silent=True)), True
+    if request.mimetype == 'multipart/form-data' and 'img' in request.files:
+        return [i.read() for i in request.files.getlist('img')], False
+    return request.form.getlist('img'), True
+
+
+def query_deadline(query_string):
+    # asgi的查询字符串,和client_deadline一致
+    return timeout_deadline(parse_qs(query_string.decode('latin-1')).get('timeout', [None])[0])
+
+
+def parse_form(content_type, body):
+    # 返回[(字段名, 值, 是否为上传的文件)],值为字节
+    mimetype = content_type.split(';')[0].strip()
+    if mimetype == 'multipart/form-data':
+        message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\\r\\n\\r\\n' + body)
+        return [(part.get_param('name', header='content-disposition'), part.get_payload(decode=True),
+                 part.get_filename() is not None) for part in message.get_payload()]
+    return [(key.decode(), value, False) for key, values in parse_qs(body).items() for value in values]
+
+
+def body_image(content_type, body):
+    # 和request_image一致
+    if content_type.split(';')[0].strip() == 'application/octet-stream':
+        return body
+    for name, value, is_file in parse_form(content_type, body):
+        if name == 'img' and value:
+            if is_file:
+                return value
+            return decode_base64(value)
+    return None
+
+
+def body_images(content_type, body):
+    # 和request_images一致,返回(图片列表, 是否为base64)
+    if content_type.split(';')[0].strip() == 'application/json':
+        return json_images(json.loads(body)), True
+    fields = [(value, is_file) for name, value, is_file in parse_form(content_type, body) if name == 'img']
+    if fields and all(is_file for value, is_file in fields):
+        return [value for value, is_file in fields], False
+    return [value for value, is_file in fields], True
+"""
+
+
+def serving(work_path, project_name):
+    return f"""# app.py和asgi_app.py共用的设备设置和模型加载
+import gc
+import os
+import time
 import operator
+import threading
+import collections
+import importlib.util
 import tensorflow as tf
-from flask import Flask
-from flask import request
 from loguru import logger
 from {work_path}.{project_name}.models import Models
+from {work_path}.{project_name}.models import DropBlock
 from {work_path}.{project_name}.settings import USE_GPU
 from {work_path}.{project_name}.settings import MODEL
 from {work_path}.{project_name}.settings import MODEL_NAME
-from {work_path}.{project_name}.settings import n_class_file
 from {work_path}.{project_name}.settings import checkpoint_path
 from {work_path}.{project_name}.settings import App_model_path
+from {work_path}.{project_name}.settings import serving_model_path
+from {work_path}.{project_name}.settings import cascade_model_path
+from {work_path}.{project_name}.settings import USE_SERVING_MODEL
+from {work_path}.{project_name}.settings import USE_TFLITE_MODEL
+from {work_path}.{project_name}.settings import USE_CASCADE
+from {work_path}.{project_name}.settings import MODEL_MEMORY_BUDGET
+from {work_path}.{project_name}.settings import RELOAD_INTERVAL
+from {work_path}.{project_name}.settings import projects_path
 from {work_path}.{project_name}.callback import CallBack
-from {work_path}.{project_name}.utils import Predict_Image
-
-
-if USE_GPU:
-    gpus = tf.config.experimental.list_physical_devices(device_type="GPU")
-    if gpus:
-        logger.info("use gpu device")
-        logger.info(f'可用GPU数量: {{len(gpus)}}')
-        try:
-            tf.config.experimental.set_visible_devices(gpus[0], 'GPU')
-        except RuntimeError as e:
-            logger.error(e)
-        for gpu in gpus:
-            tf.config.experimental.set_memory_growth(device=gpu, enable=True)
-            tf.print(gpu)
+from {work_path}.{project_name}.utils import Inference_Model
+from {work_path}.{project_name}.utils import Serving_Predict
+from {work_path}.{project_name}.utils import TFLite_Predict
+from {work_path}.{project_name}.utils import Cascade_Predict
+from {work_path}.{project_name}.utils import tflite_file
+from {work_path}.{project_name}.utils import Batch_Predict
+from {work_path}.{project_name}.utils import Result_Cache
+from {work_path}.{project_name}.utils import Model_Closed
+
+
+def configure_device():
+    if USE_GPU:
+        gpus = tf.config.experimental.list_physical_devices(device_type="GPU")
+        if gpus:
+            logger.info("use gpu device")
+            logger.info(f'可用GPU数量: {{len(gpus)}}')
+            try:
+                tf.config.experimental.set_visible_devices(gpus[0], 'GPU')
+            except RuntimeError as e:
+                logger.error(e)
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(device=gpu, enable=True)
+                tf.print(gpu)
+        else:
+            tf.config.experimental.list_physical_devices(device_type="CPU")
+            os.environ["CUDA_VISIBLE_DEVICE"] = "-1"
+            logger.info("not found gpu device,convert to use cpu")
     else:
+        logger.info("use cpu device")
+        # 禁用gpu
         tf.config.experimental.list_physical_devices(device_type="CPU")
         os.environ["CUDA_VISIBLE_DEVICE"] = "-1"
-        logger.info("not found gpu device,convert to use cpu")
-else:
-    logger.info("use cpu device")
-    # 禁用gpu
-    tf.config.experimental.list_physical_devices(device_type="CPU")
-    os.environ["CUDA_VISIBLE_DEVICE"] = "-1"
 
-app = Flask(__name__)
-if App_model_path:
-    model_path = os.path.join(App_model_path,os.listdir(App_model_path)[0])
-    logger.debug(f'{{model_path}}模型加载成功')
-else:
+
+def app_model_path():
+    # 使用App_model里最新的模型,没有模型时用损失最小的检查点生成一个
+    if os.listdir(App_model_path):
+        return max([os.path.join(App_model_path, name) for name in os.listdir(App_model_path)], key=os.path.getmtime)
     model = operator.methodcaller(MODEL)(Models)
     try:
         model.load_weights(os.path.join(checkpoint_path, CallBack.calculate_the_best_weight()))
@@ -239,30 +482,508 @@ else:
         raise OSError(f'没有任何的权重和模型在{{App_model_path}}')
     model_path = os.path.join(App_model_path, MODEL_NAME)
     model.save(model_path)
+    return model_path
+
+
+def cascade_model_file():
+    # 级联预测使用cascade_model里最新的小模型
+    if not os.listdir(cascade_model_path):
+        raise OSError(f'没有任何的模型在{{cascade_model_path}}')
+    return max([os.path.join(cascade_model_path, name) for name in os.listdir(cascade_model_path)],
+               key=os.path.getmtime)
+
+
+def load_model_file(model_path):
+    # 按后缀加载模型文件,.tflite用TFLite解释器,其他为keras模型
+    if model_path.endswith('.tflite'):
+        return TFLite_Predict(model_path).warmup()
+    model = tf.keras.models.load_model(model_path, compile=False, custom_objects={{'DropBlock': DropBlock}})
+    return Inference_Model(model).warmup()
+
+
+def load_model():
+    # 返回预热好的模型,predict_on_batch可以直接交给Batch_Predict
+    if USE_SERVING_MODEL:
+        model = Serving_Predict(serving_model_path).warmup()
+        logger.debug(f'{{serving_model_path}}模型加载成功')
+        return model
+    model_path = tflite_file(USE_TFLITE_MODEL) if USE_TFLITE_MODEL else app_model_path()
+    model = load_model_file(model_path)
     logger.debug(f'{{model_path}}模型加载成功')
+    if USE_CASCADE:
+        small_model_path = cascade_model_file()
+        model = Cascade_Predict(load_model_file(small_model_path), model)
+        logger.debug(f'{{small_model_path}}级联预测的小模型加载成功')
+    return model
+
+
+def model_signature(path):
+    # 模型目录下所有文件的(相对路径, 大小, 修改时间),模型有变化时签名不同
+    return sorted((os.path.relpath(os.path.join(root, name), path), os.path.getsize(os.path.join(root, name)),
+                   os.path.getmtime(os.path.join(root, name))) for root, dirs, files in os.walk(path) for name in files)
+
+
+# 模型热更新: 后台线程每隔RELOAD_INTERVAL秒检查模型目录,或者直接调用reload
+# 新模型在后台加载预热完成后才替换,正在计算的batch继续用旧模型,请求不中断
+class Model_Reloader(object):
+    def __init__(self, batch_predict, result_cache=None, interval=RELOAD_INTERVAL):
+        self.batch_predict = batch_predict
+        self.result_cache = result_cache
+        self.interval = interval
+        if USE_SERVING_MODEL:
+            self.path = serving_model_path
+        elif USE_TFLITE_MODEL:
+            self.path = os.path.dirname(tflite_file(USE_TFLITE_MODEL))
+        else:
+            self.path = App_model_path
+        self.signature = model_signature(self.path)
+        self.lock = threading.Lock()
+        self.reload_number = 0
+        self.reload_time = None
+        if interval:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        last_signature = self.signature
+        while True:
+            time.sleep(self.interval)
+            try:
+                signature = model_signature(self.path)
+                # 连续两次检查都一样才加载,避免读到还没复制完的模型
+                if signature and signature != self.signature and signature == last_signature:
+                    self.reload()
+                last_signature = signature
+            except Exception as e:
+                logger.error(f'模型热更新失败:{{e}}')
+
+    def reload(self):
+        # 返回加载、预热和替换的总耗时;加载失败时继续用旧模型,直到模型目录再次变化
+        with self.lock:
+            start_time = time.time()
+            self.signature = model_signature(self.path)
+            if not self.signature:
+                raise OSError(f'没有任何的模型在{{self.path}}')
+            old_model = self.batch_predict.swap(load_model())
+            if self.result_cache is not None:
+                self.result_cache.clear()
+            # 正在计算的batch还引用着旧模型,计算完成后旧模型的内存才会释放
+            del old_model
+            gc.collect()
+            self.reload_number = self.reload_number + 1
+            self.reload_time = time.time() - start_time
+            logger.info(f'模型热更新完成,耗时{{self.reload_time}}s')
+            return self.reload_time
+
+    def report(self):
+        return {{'path': self.path, 'reload_number': self.reload_number, 'reload_time': self.reload_time}}
+
+
+def project_settings(project_path):
+    # 读取其他项目的settings.py,只用MODE这类和路径无关的设置
+    spec = importlib.util.spec_from_file_location(f'{{os.path.basename(project_path)}}_settings',
+                                                  os.path.join(project_path, 'settings.py'))
+    settings = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(settings)
+    return settings
+
+
+def path_size(path):
+    # 模型文件(夹)的大小,用来估算模型占用的内存
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(path) for name in files)
+
+
+# 多模型服务: 按项目名按需加载projects_path下各个项目的模型,所有模型共用一个TensorFlow运行时和线程池
+# 常驻模型的总大小超过MODEL_MEMORY_BUDGET时淘汰最久没有使用的模型,每个模型使用自己项目的num_classes.json和MODE
+class Model_Registry(object):
+    def __init__(self, path=projects_path, memory_budget=MODEL_MEMORY_BUDGET):
+        self.path = path
+        self.memory_budget = memory_budget * 1024 * 1024
+        # 项目名: (Batch_Predict, 模型大小),越靠后越是最近使用的
+        self.models = collections.OrderedDict()
+        # 每个模型单独的识别结果缓存,淘汰模型时保留;多个模型共用sqlite会串结果,所以只用进程内缓存
+        self.caches = {{}}
+        self.loading = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+        self.load_number = 0
+        self.evict_number = 0
+
+    def projects(self):
+        # 有num_classes.json的目录都当作项目
+        return sorted(name for name in os.listdir(self.path) if
+                      os.path.isfile(os.path.join(self.path, name, 'num_classes.json')))
+
+    def resident(self, name):
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name][0]
+        return None
+
+    def get(self, name):
+        # 返回name对应模型的Batch_Predict,不在内存里时加载
+        batch_predict = self.resident(name)
+        if batch_predict:
+            return batch_predict
+        if name not in self.projects():
+            raise KeyError(f'没有{{name}}这个模型')
+        # 同一个模型的并发请求只加载一次
+        with self.loading[name]:
+            batch_predict = self.resident(name)
+            if batch_predict:
+                return batch_predict
+            batch_predict, memory = self.load(name)
+            with self.lock:
+                self.models[name] = (batch_predict, memory)
+                self.load_number = self.load_number + 1
+                self.evict()
+        return batch_predict
+
+    def call(self, name, function, retries=3):
+        # 用name对应的Batch_Predict调用function,拿到之后刚好被其他线程淘汰(Model_Closed)时重新获取,不让请求失败
+        for _ in range(retries):
+            try:
+                return function(self.get(name))
+            except Model_Closed:
+                logger.warning(f'{{name}}模型刚被淘汰,重新获取')
+        return function(self.get(name))
+
+    def cache(self, name):
+        with self.lock:
+            if name not in self.caches:
+                self.caches[name] = Result_Cache(backend=None)
+            return self.caches[name]
+
+    def load(self, name):
+        start_time = time.time()
+        project_path = os.path.join(self.path, name)
+        settings = project_settings(project_path)
+        app_path = os.path.join(project_path, 'App_model')
+        serving_path = os.path.join(project_path, 'serving_model')
+        if USE_SERVING_MODEL and os.path.isdir(serving_path):
+            model_path = serving_path
+            model = Serving_Predict(serving_path).warmup()
+        elif os.path.isdir(app_path) and os.listdir(app_path):
+            model_path = max([os.path.join(app_path, name) for name in os.listdir(app_path)], key=os.path.getmtime)
+            model = load_model_file(model_path)
+        else:
+            raise OSError(f'没有任何的模型在{{app_path}}')
+        batch_predict = Batch_Predict(model, num_classes=os.path.join(project_path, 'num_classes.json'),
+                                      mode=settings.MODE)
+        logger.info(f'{{name}}模型加载成功,耗时{{time.time() - start_time}}s')
+        return batch_predict, path_size(model_path)
+
+    def memory(self):
+        return sum(memory for batch_predict, memory in self.models.values())
+
+    def evict(self):
+        # 超出内存预算时淘汰最久没有使用的模型,至少保留刚加载的模型
+        evicted = False
+        while len(self.models) > 1 and self.memory() > self.memory_budget:
+            name, (batch_predict, memory) = self.models.popitem(last=False)
+            batch_predict.close()
+            self.evict_number = self.evict_number + 1
+            evicted = True
+            logger.info(f'淘汰了{{name}}模型,释放约{{memory / 1024 / 1024:.1f}}MB')
+        if evicted:
+            gc.collect()
+
+    def report(self):
+        with self.lock:
+            return {{'projects': self.projects(), 'memory': self.memory(), 'memory_budget': self.memory_budget,
+                    'load_number': self.load_number, 'evict_number': self.evict_number,
+                    'models': {{name: {{'memory': memory, 'batch': batch_predict.report()}} for
+                               name, (batch_predict, memory) in self.models.items()}},
+                    'cache': {{name: cache.report() for name, cache in self.caches.items()}}}}
+
+"""
+
+
+def asgi_app(work_path, project_name):
+    return f"""# 异步后端,读取请求和解码都不阻塞事件循环,预测交给动态批处理的线程
+# 启动: python asgi_app.py 或者 uvicorn {work_path}.{project_name}.asgi_app:app --port 5006
+import json
+import time
+import asyncio
+from loguru import logger
+from concurrent.futures import ThreadPoolExecutor
+from {work_path}.{project_name}.settings import n_class_file
+from {work_path}.{project_name}.settings import DECODE_WORKERS
+from {work_path}.{project_name}.serving import load_model
+from {work_path}.{project_name}.serving import configure_device
+from {work_path}.{project_name}.serving import Model_Reloader
+from {work_path}.{project_name}.utils import Predict_Image
+from {work_path}.{project_name}.utils import Batch_Predict
+from {work_path}.{project_name}.utils import Result_Cache
+from {work_path}.{project_name}.utils import Cascade_Predict
+from {work_path}.{project_name}.utils import Request_Shed
+from {work_path}.{project_name}.utils import metrics
+from {work_path}.{project_name}.api_request import query_deadline
+from {work_path}.{project_name}.api_request import body_image
+from {work_path}.{project_name}.api_request import body_images
+
+configure_device()
+
+model = load_model()
+batch_predict = Batch_Predict(model, num_classes=n_class_file)
+result_cache = Result_Cache()
+model_reloader = Model_Reloader(batch_predict, result_cache)
+metrics.gauge('captcha_queue_depth', '等待批处理和/batch正在预测的图片数', batch_predict.depth)
+executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+
+
+async def read_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        body.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(body)
+
+
+async def send_json(send, data, status=200):
+    await send_body(send, json.dumps(data, ensure_ascii=False).encode('utf-8'), b'application/json; charset=utf-8',
+                    status=status)
+
+
+async def send_body(send, body, content_type, status=200):
+    await send({{'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]}})
+    await send({{'type': 'http.response.body', 'body': body}})
+
+
+async def captcha_predict(content_type, body, deadline):
+    # 返回(结果, HTTP状态码),过载保护丢弃的请求为503
+    return_dict = {{'return_code': '200', 'return_info': '处理成功', 'result': False, 'recognition_rate': 0, 'time': None}}
+    start_time = time.time()
+    status = 200
+    loop = asyncio.get_event_loop()
+    try:
+        image = await loop.run_in_executor(executor, body_image, content_type, body)
+        if image:
+            future = await loop.run_in_executor(executor, result_cache.get_or_submit, image,
+                                                lambda image: batch_predict.submit_bytes(image, deadline))
+            result, recognition_rate = await asyncio.wrap_future(future)
+            times = time.time() - start_time
+            return_dict['time'] = str(times)
+            return_dict['result'] = str(result)
+            return_dict['recognition_rate'] = str(recognition_rate)
+        else:
+            return_dict['return_code'] = '5004'
+            return_dict['return_info'] = '参数错误，没有img属性'
+    except Request_Shed as e:
+        status = 503
+        return_dict['return_code'] = e.return_code
+        return_dict['return_info'] = e.return_info
+    except Exception as e:
+        return_dict['result'] = str(e)
+        return_dict['return_info'] = '模型识别错误'
+    metrics.request(return_dict['return_code'], time.time() - start_time)
+    logger.debug(return_dict)
+    return return_dict, status
+
+
+async def captcha_predict_batch(content_type, body, deadline):
+    # 和captcha_predict一样返回(结果, HTTP状态码)
+    return_dict = {{'return_code': '200', 'return_info': '处理成功', 'result': [], 'time': None}}
+    start_time = time.time()
+    status = 200
+    loop = asyncio.get_event_loop()
+    try:
+        image_list, encoded = await loop.run_in_executor(executor, body_images, content_type, body)
+        if image_list and isinstance(image_list, list):
+            predict_image = Predict_Image(image=image_list, num_classes=n_class_file)
+            results, times = await loop.run_in_executor(executor, predict_image.api_batch, batch_predict,
+                                                        result_cache, encoded, deadline)
+            return_dict['time'] = str(times)
+            return_dict['result'] = [{{'result': str(result), 'recognition_rate': str(recognition_rate)}} for
+                                     result, recognition_rate in results]
+        else:
+            return_dict['return_code'] = '5004'
+            return_dict['return_info'] = '参数错误，没有img属性'
+    except Request_Shed as e:
+        status = 503
+        return_dict['return_code'] = e.return_code
+        return_dict['return_info'] = e.return_info
+    except Exception as e:
+        return_dict['result'] = str(e)
+        return_dict['return_info'] = '模型识别错误'
+    metrics.request(return_dict['return_code'], time.time() - start_time)
+    logger.debug(return_dict)
+    return return_dict, status
+
+
+async def captcha_reload(client):
+    # 和app.py的/reload一致,加载放到默认线程池,不占用解码的线程
+    return_dict = {{'return_code': '200', 'return_info': '处理成功', 'time': None}}
+    if not client or client[0] not in ('127.0.0.1', '::1'):
+        return_dict['return_code'] = '5003'
+        return_dict['return_info'] = '只能在本机调用'
+        return return_dict
+    try:
+        return_dict['time'] = str(await asyncio.get_event_loop().run_in_executor(None, model_reloader.reload))
+    except Exception as e:
+        return_dict['return_code'] = '5002'
+        return_dict['return_info'] = f'模型热更新失败:{{e}}'
+    logger.debug(return_dict)
+    return return_dict
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({{'type': 'lifespan.startup.complete'}})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({{'type': 'lifespan.shutdown.complete'}})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return None
+    path, method = scope['path'], scope['method']
+    headers = dict(scope['headers'])
+    content_type = headers.get(b'content-type', b'').decode('latin-1')
+    if path == '/' and method == 'POST':
+        deadline = query_deadline(scope['query_string'])
+        return_dict, status = await captcha_predict(content_type, await read_body(receive), deadline)
+        await send_json(send, return_dict, status=status)
+    elif path == '/batch' and method == 'POST':
+        deadline = query_deadline(scope['query_string'])
+        return_dict, status = await captcha_predict_batch(content_type, await read_body(receive), deadline)
+        await send_json(send, return_dict, status=status)
+    elif path == '/stats' and method == 'GET':
+        cascade = batch_predict.model.report() if isinstance(batch_predict.model, Cascade_Predict) else None
+        await send_json(send, {{'batch': batch_predict.report(), 'cache': result_cache.report(),
+                               'reload': model_reloader.report(), 'cascade': cascade}})
+    elif path == '/reload' and method == 'POST':
+        await send_json(send, await captcha_reload(scope.get('client')))
+    elif path == '/metrics' and method == 'GET':
+        await send_body(send, metrics.render().encode('utf-8'), b'text/plain; version=0.0.4; charset=utf-8')
+    else:
+        await send_json(send, {{'return_code': '404', 'return_info': '没有这个接口'}}, status=404)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=5006)
 
-model = tf.keras.models.load_model(model_path)
+"""
+
+
+def multi_app(work_path, project_name):
+    return f"""# 多模型后端: 一个进程按model参数调用{work_path}下各个项目的模型,接口和app.py一致
+# 例: POST /?model=项目名,也可以把model放在表单里
+import json
+import time
+from flask import Flask
+from flask import request
+from loguru import logger
+from {work_path}.{project_name}.serving import configure_device
+from {work_path}.{project_name}.serving import Model_Registry
+from {work_path}.{project_name}.utils import Predict_Image
+from {work_path}.{project_name}.utils import Request_Shed
+from {work_path}.{project_name}.utils import metrics
+from {work_path}.{project_name}.api_request import client_deadline
+from {work_path}.{project_name}.api_request import request_image
+from {work_path}.{project_name}.api_request import request_images
+
+configure_device()
+
+app = Flask(__name__)
+registry = Model_Registry()
+
+
+def request_model():
+    return request.args.get('model') or request.form.get('model')
 
 
 @app.route("/", methods=['POST'])
 def captcha_predict():
     return_dict = {{'return_code': '200', 'return_info': '处理成功', 'result': False, 'recognition_rate': 0, 'time': None}}
-    get_data = request.form.to_dict()
-    if 'img' in get_data.keys():
-        base64_str = request.form['img']
-        try:
-            result, recognition_rate, times = Predict_Image(model, image=base64_str, num_classes=n_class_file).api()
+    start_time = time.time()
+    deadline = client_deadline(request)
+    status = 200
+    try:
+        name = request_model()
+        image = request_image(request)
+        if name and image:
+            result, recognition_rate = registry.cache(name).get_or_predict(
+                image, lambda image: registry.call(
+                    name, lambda batch_predict: batch_predict.predict_bytes(image, deadline)))
+            times = time.time() - start_time
             return_dict['time'] = str(times)
             return_dict['result'] = str(result)
             return_dict['recognition_rate'] = str(recognition_rate)
+        else:
+            return_dict['return_code'] = '5004'
+            return_dict['return_info'] = '参数错误，没有img或者model属性'
+    except KeyError as e:
+        return_dict['return_code'] = '5004'
+        return_dict['return_info'] = e.args[0]
+    except Request_Shed as e:
+        status = 503
+        return_dict['return_code'] = e.return_code
+        return_dict['return_info'] = e.return_info
+    except Exception as e:
+        return_dict['result'] = str(e)
+        return_dict['return_info'] = '模型识别错误'
+    metrics.request(return_dict['return_code'], time.time() - start_time)
+    logger.debug(return_dict)
+    return json.dumps(return_dict, ensure_ascii=False), status
+
+
+@app.route("/batch", methods=['POST'])
+def captcha_predict_batch():
+    # 和app.py的/batch一致,多一个model参数
+    return_dict = {{'return_code': '200', 'return_info': '处理成功', 'result': [], 'time': None}}
+    start_time = time.time()
+    deadline = client_deadline(request)
+    status = 200
+    image_list, encoded = request_images(request)
+    name = request_model()
+    if name and image_list and isinstance(image_list, list):
+        try:
+            results, times = registry.call(name, lambda batch_predict: Predict_Image(image=image_list).api_batch(
+                batch_predict, registry.cache(name), encoded=encoded, deadline=deadline))
+            return_dict['time'] = str(times)
+            return_dict['result'] = [{{'result': str(result), 'recognition_rate': str(recognition_rate)}} for
+                                     result, recognition_rate in results]
+        except KeyError as e:
+            return_dict['return_code'] = '5004'
+            return_dict['return_info'] = e.args[0]
+        except Request_Shed as e:
+            status = 503
+            return_dict['return_code'] = e.return_code
+            return_dict['return_info'] = e.return_info
         except Exception as e:
             return_dict['result'] = str(e)
             return_dict['return_info'] = '模型识别错误'
     else:
         return_dict['return_code'] = '5004'
-        return_dict['return_info'] = '参数错误，没有img属性'
+        return_dict['return_info'] = '参数错误，没有img或者model属性'
+    metrics.request(return_dict['return_code'], time.time() - start_time)
     logger.debug(return_dict)
-    return json.dumps(return_dict, ensure_ascii=False)
+    return json.dumps(return_dict, ensure_ascii=False), status
+
+
+@app.route("/stats", methods=['GET'])
+def captcha_stats():
+    # 可用的项目,常驻的模型和各自的批处理、缓存统计
+    return json.dumps(registry.report(), ensure_ascii=False)
+
+
+@app.route("/metrics", methods=['GET'])
+def captcha_metrics():
+    # Prometheus文本格式的指标,每个进程单独统计
+    return metrics.render(), 200, {{'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}}
 
 
 if __name__ == '__main__':
@@ -271,6 +992,98 @@ if __name__ == '__main__':
 """
 
 
+def server(work_path, project_name):
+    return f"""# 多进程启动后端(linux): 主进程只监听端口,fork出WORKER_NUMBER个进程共享同一个socket,由内核分配连接
+# 每个进程绑定各自的CPU核心并限制TensorFlow的线程数,避免进程之间抢核
+# TensorFlow的线程池在fork之后不可用,所以模型在每个进程fork之后再加载
+import os
+import sys
+import time
+import signal
+import socket
+from loguru import logger
+from {work_path}.{project_name}.settings import WORKER_NUMBER
+from {work_path}.{project_name}.settings import INTRA_OP_THREADS
+from {work_path}.{project_name}.settings import INTER_OP_THREADS
+from {work_path}.{project_name}.settings import CPU_AFFINITY
+
+HOST = '0.0.0.0'
+PORT = 5006
+
+
+def worker_cpus(index):
+    # 把可用的核心平均分给每个进程,核心比进程少时轮流分配
+    cpus = sorted(os.sched_getaffinity(0))
+    number = max(len(cpus) // WORKER_NUMBER, 1)
+    start = (index * number) % len(cpus)
+    return cpus[start:start + number]
+
+
+def run_worker(index, listen_socket):
+    # 重新拉起的进程会继承主进程停止所有进程的信号处理,恢复成默认处理
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    cpus = worker_cpus(index)
+    if CPU_AFFINITY:
+        os.sched_setaffinity(0, cpus)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(INTRA_OP_THREADS or len(cpus))
+    tf.config.threading.set_inter_op_parallelism_threads(INTER_OP_THREADS)
+    logger.info(f'进程{{os.getpid()}}使用的核心为{{cpus}}')
+    from werkzeug.serving import make_server
+    from {work_path}.{project_name}.app import app
+    server = make_server(HOST, PORT, app, threaded=True, fd=listen_socket.fileno())
+    server.serve_forever()
+
+
+def start_worker(index, listen_socket):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(index, listen_socket)
+        except Exception as e:
+            logger.error(e)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def main():
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((HOST, PORT))
+    listen_socket.listen(1024)
+    workers = dict((start_worker(index, listen_socket), index) for index in range(WORKER_NUMBER))
+    logger.info(f'启动了{{WORKER_NUMBER}}个后端进程,监听{{PORT}}端口')
+
+    def stop(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while True:
+        # 进程意外退出时重新拉起
+        pid, status = os.wait()
+        index = workers.pop(pid, None)
+        if index is not None:
+            logger.error(f'后端进程{{pid}}退出,状态码{{status}},重新启动')
+            time.sleep(1)
+            workers[start_worker(index, listen_socket)] = index
+
+
+if __name__ == '__main__':
+    if not hasattr(os, 'fork'):
+        raise OSError('多进程启动只支持linux,请直接运行app.py')
+    main()
+
+"""
+
+
 def captcha_config():
     return '''{
   "train_dir": "train_dataset",
@@ -373,9 +1186,16 @@ import re
 import os
 import json
 import time
+import queue
 import shutil
 import base64
 import random
+import sqlite3
+import hashlib
+import threading
+import contextlib
+import collections
+import multiprocessing
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
@@ -396,7 +1216,36 @@ from {work_path}.{project_name}.settings import IMAGE_WIDTH
 from {work_path}.{project_name}.settings import CAPTCHA_LENGTH
 from {work_path}.{project_name}.settings import IMAGE_CHANNALS
 from {work_path}.{project_name}.settings import DATA_ENHANCEMENT
+from {work_path}.{project_name}.settings import PACK_SHARD_SIZE
+from {work_path}.{project_name}.settings import PACK_WORKERS
+from {work_path}.{project_name}.settings import PACK_FORMAT
+from {work_path}.{project_name}.settings import PACK_INCREMENTAL
+from {work_path}.{project_name}.settings import BATCH_SIZE
+from {work_path}.{project_name}.settings import DATASET_CACHE
+from {work_path}.{project_name}.settings import SHUFFLE_BUFFER_SIZE
+from {work_path}.{project_name}.settings import INTERLEAVE_CYCLE
+from {work_path}.{project_name}.settings import DATA_ECHO
+from {work_path}.{project_name}.settings import BATCH_MAX_SIZE
+from {work_path}.{project_name}.settings import BATCH_MAX_WAIT
+from {work_path}.{project_name}.settings import BATCH_REPORT_FREQ
+from {work_path}.{project_name}.settings import QUEUE_MAX_SIZE
+from {work_path}.{project_name}.settings import REQUEST_TIMEOUT
+from {work_path}.{project_name}.settings import DECODE_WORKERS
+from {work_path}.{project_name}.settings import WARMUP_BATCH_SIZES
+from {work_path}.{project_name}.settings import CTC_BEAM_WIDTH
+from {work_path}.{project_name}.settings import CACHE_SIZE
+from {work_path}.{project_name}.settings import CACHE_TTL
+from {work_path}.{project_name}.settings import CACHE_BACKEND
+from {work_path}.{project_name}.settings import TFLITE_POOL_SIZE
+from {work_path}.{project_name}.settings import TFLITE_THREADS
+from {work_path}.{project_name}.settings import MODEL_NAME
+from {work_path}.{project_name}.settings import CASCADE_THRESHOLD
+from {work_path}.{project_name}.settings import model_path
+from {work_path}.{project_name}.settings import dataset_cache_path
+from concurrent.futures import wait
+from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 
 right_value = 0
 predicted_value = 0
@@ -514,30 +1363,61 @@ class Image_Processing(object):
         else:
             raise ValueError(f'没有mode={{mode}}提取标签的方法')
 
+    @classmethod
+    def extraction_vocabulary(self, path_list: list, suffix=True, divide='_', mode=MODE) -> list:
+        # 和extraction_label一样从文件名取出标签,返回排好序的字符,NUM_CLASSES模式为类别
+        paths = [os.path.splitext(os.path.split(i)[-1])[0] for i in path_list]
+        if suffix:
+            paths = [re.split(divide, i)[0] for i in paths]
+        if mode == 'NUM_CLASSES':
+            return sorted(set(paths))
+        return sorted(set(''.join(paths)))
+
+    @classmethod
+    def update_vocabulary(self, path_list: list, suffix=True, divide='_', mode=MODE) -> bool:
+        # 打包前检查映射表,返回已经打包的标签是否失效(需要全部重新打包)
+        # 新的字符(类别)追加到映射表末尾,已有的下标不变;ORDINARY用最后一类表示空白,字符数变了空白的下标也会变,只能重新生成映射表
+        vocabulary = self.extraction_vocabulary(path_list, suffix=suffix, divide=divide, mode=mode)
+        if os.path.exists(n_class_file):
+            with open(n_class_file, 'r', encoding='utf-8') as f:
+                make_dict = json.loads(f.read())
+            names = [make_dict[str(index)] for index in range(len(make_dict))]
+            known = set(names)
+            new_names = [name for name in vocabulary if name not in known]
+            if not new_names:
+                return False
+            if mode != 'ORDINARY':
+                logger.warning(f'映射表新增{{len(new_names)}}个字符(类别),追加到末尾,已经打包的数据不用重新打包,模型需要重新训练')
+                with open(n_class_file, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps(dict(enumerate(names + new_names)), ensure_ascii=False))
+                return False
+            logger.warning(f'映射表新增{{len(new_names)}}个字符,空白类的下标改变,全部重新打包,模型需要重新训练')
+        with open(n_class_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(dict(enumerate(vocabulary)), ensure_ascii=False))
+        return True
+
     @classmethod
     def text2vector(self, label, make_dict: dict, mode=MODE):
+        # 标签都保存为字符(或类别)的下标,one-hot在parse_function里展开
         if mode == 'ORDINARY':
             if len(label) > CAPTCHA_LENGTH:
                 raise ValueError(f'标签{{label}}长度大于预设值{{label}},建议设置CAPTCHA_LENGTH为{{len(label) + 2}}')
             num_classes = len(make_dict)
+            # 不足CAPTCHA_LENGTH的位置填num_classes,对应最后一类空白
             label_ver = np.ones((CAPTCHA_LENGTH), dtype=np.int64) * num_classes
             for index, c in enumerate(label):
-                if not make_dict.get(c):
+                if c not in make_dict:
                     raise ValueError(f'错误的值{{c}}')
-                label_ver[index] = make_dict.get(c)
-            label_ver = list(tf.keras.utils.to_categorical(label_ver, num_classes=num_classes + 1).ravel())
+                label_ver[index] = int(make_dict[c])
             return label_ver
         elif mode == 'NUM_CLASSES':
-            num_classes = len(make_dict)
-            label_ver = np.zeros((num_classes), dtype=np.int64) * num_classes
-            label_ver[int(make_dict.get(label))] = 1.
-            return label_ver
+            return np.array([int(make_dict[label])], dtype=np.int64)
         elif mode == 'CTC':
             label_ver = []
             for c in label:
-                if not make_dict.get(c):
+                if c not in make_dict:
                     raise ValueError(f'错误的值{{c}}')
-                label_ver.append(int(make_dict.get(c)))
+                label_ver.append(int(make_dict[c]))
             label_ver = np.array(label_ver)
             return label_ver
         else:
@@ -642,8 +1522,8 @@ class Image_Processing(object):
 
     @classmethod
     def preprosess_save_images(self, image, number):
+        # 返回这张图片增强后的所有文件(包括复制过去的原图)
         logger.info(f'开始处理{{image}}')
-        name = os.path.splitext(image)[0]
         datagen = tf.keras.preprocessing.image.ImageDataGenerator(featurewise_center=False,
                                                                   samplewise_center=False,
                                                                   featurewise_std_normalization=False,
@@ -666,16 +1546,59 @@ class Image_Processing(object):
                                                                   data_format=None,
                                                                   validation_split=0.0,
                                                                   dtype=None)
-        shutil.copy(image, train_enhance_path)
+        stem, suffix = os.path.splitext(os.path.basename(image))
+        outputs = [os.path.join(train_enhance_path, stem + suffix)]
+        shutil.copy(image, outputs[0])
         img = tf.keras.preprocessing.image.load_img(image)
         x = tf.keras.preprocessing.image.img_to_array(img)
         x = np.expand_dims(x, 0)
-        i = 0
-        for _ in datagen.flow(x, batch_size=1, save_to_dir=train_enhance_path, save_prefix=name, save_format='jpg'):
-            i += 1
-            if i == DATA_ENHANCEMENT:
+        # 增强出的图片按源图片的文件名编号,重新增强时覆盖,文件名的第一段仍然是标签
+        for index, batch in enumerate(datagen.flow(x, batch_size=1)):
+            output = os.path.join(train_enhance_path, f'{{stem}}_{{index}}.jpg')
+            tf.keras.preprocessing.image.array_to_img(batch[0], scale=True).save(output)
+            outputs.append(output)
+            if index + 1 == DATA_ENHANCEMENT:
                 break
         logger.success(f'处理完成{{image}},还剩{{number}}张图片待增强')
+        return outputs
+
+    @classmethod
+    def enhance_images(self, images: list, path=train_enhance_path):
+        # enhance.json记录每张源图片的大小、修改时间和增强出的文件,只增强新增和修改的源图片,以前增强出的图片继续使用
+        # 源图片删除或修改时删除它以前增强出的文件,返回所有增强后的图片
+        record_file = os.path.join(path, 'enhance.json')
+        records = {{}}
+        if os.path.exists(record_file):
+            with open(record_file, 'r', encoding='utf-8') as f:
+                records = json.loads(f.read())
+        sources = dict((os.path.relpath(image), image) for image in images)
+        for key in list(records):
+            stat = os.stat(sources[key]) if key in sources else None
+            record = records[key]
+            if stat and (record['size'], record['mtime'], record['number']) == (
+                    stat.st_size, stat.st_mtime, DATA_ENHANCEMENT):
+                continue
+            for name in record['outputs']:
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+            del records[key]
+        pending = [(key, image) for key, image in sources.items() if key not in records]
+        logger.info(f'一共{{len(sources)}}张图片,需要增强{{len(pending)}}张')
+        with ThreadPoolExecutor(max_workers=100) as t:
+            futures = [t.submit(self.preprosess_save_images, image, len(pending) - index - 1) for index, (key, image) in
+                       enumerate(pending)]
+        for (key, image), future in zip(pending, futures):
+            # 增强失败的图片不记录,下次打包时重新增强
+            if future.exception() is not None:
+                logger.error(f'{{image}}增强失败:{{future.exception()}}')
+                continue
+            stat = os.stat(image)
+            records[key] = {{'size': stat.st_size, 'mtime': stat.st_mtime, 'number': DATA_ENHANCEMENT,
+                            'outputs': [os.path.basename(output) for output in future.result()]}}
+        with open(record_file + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps(records, ensure_ascii=False, separators=(',', ':')))
+        os.replace(record_file + '.tmp', record_file)
+        return [os.path.join(path, name) for record in records.values() for name in record['outputs']]
 
     @classmethod
     # 展示图片处理后的效果
@@ -751,9 +1674,19 @@ class Image_Processing(object):
 
 
 # 打包数据
+# 打包进程共享的已打包图片数,由进程池的initializer设置
+pack_counter = None
+
+
+def init_pack_worker(counter):
+    global pack_counter
+    pack_counter = counter
+
+
 class WriteTFRecord(object):
     @staticmethod
-    def pad_image(image_path):
+    def pad_image(image_path, image_format=PACK_FORMAT):
+        # 等比缩小后填充到IMAGE_HEIGHT×IMAGE_WIDTH,按image_format返回JPEG、PNG或者uint8张量的原始字节
         image = Image.open(image_path)
         if image.mode != 'RGB':
             image = image.convert('RGB')
@@ -771,141 +1704,472 @@ class WriteTFRecord(object):
         image = np.array(image)
         image = np.pad(image, ((0, IMAGE_HEIGHT - height), (0, IMAGE_WIDTH - width), (0, 0)), 'constant',
                        constant_values=0)
+        if image_format == 'raw':
+            if IMAGE_CHANNALS == 1:
+                image = np.array(Image.fromarray(image).convert('L'))[:, :, np.newaxis]
+            return image.astype(np.uint8).tobytes()
+        if image_format not in ('jpeg', 'png'):
+            raise ValueError(f'没有{{image_format}}这种打包格式')
         image = Image.fromarray(image)
         image_bytearr = io.BytesIO()
-        image.save(image_bytearr, format='JPEG')
+        image.save(image_bytearr, format=image_format.upper())
         # plt.imshow(image)
         # plt.show()
         image_bytes = image_bytearr.getvalue()
         return image_bytes
 
     @staticmethod
-    def WriteTFRecord(TFRecord_path, datasets: list, labels: list, file_name='dataset', spilt=100, mode=MODE):
+    def serialize(image, label, mode=MODE, image_format=PACK_FORMAT):
+        # 所有模式的标签都为text2vector返回的下标
+        image_bytes = WriteTFRecord.pad_image(image, image_format=image_format)
+        example = tf.train.Example(
+            features=tf.train.Features(
+                feature={{'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_bytes])),
+                         'label': tf.train.Feature(int64_list=tf.train.Int64List(value=label))}}))
+        return example.SerializeToString()
+
+    @staticmethod
+    def write_shard(filename, datasets: list, labels: list, mode=MODE, image_format=PACK_FORMAT, report_freq=100):
+        # 在打包进程里写一个分片,先写临时文件,写完再改名,返回(分片文件名, 图片数)
+        temp_filename = filename + '.tmp'
         number = 0
-        if mode == 'CTC':
-            num_count = len(datasets)
-            labels_count = len(labels)
-            if not os.path.exists(TFRecord_path):
-                os.mkdir(TFRecord_path)
-            logger.info(f'文件个数为:{{num_count}}')
-            logger.info(f'标签个数为:{{labels_count}}')
-            while True:
-                if datasets:
-                    number = number + 1
-                    image_list = datasets[:spilt]
-                    label_list = labels[:spilt]
-                    for i in image_list:
-                        datasets.remove(i)
-                    for i in label_list:
-                        labels.remove(i)
-                    filename = file_name + str(number) + '.tfrecords'
-                    filename = os.path.join(TFRecord_path, filename)
-                    writer = tf.io.TFRecordWriter(filename)
-                    logger.info(f'开始保存{{filename}}')
-                    for image, label in zip(image_list, label_list):
-                        num_count = num_count - 1
-                        image_bytes = WriteTFRecord.pad_image(image)
-                        logger.debug(f'剩余{{num_count}}图片待打包')
-                        example = tf.train.Example(
-                            features=tf.train.Features(
-                                feature={{'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_bytes])),
-                                         'label': tf.train.Feature(int64_list=tf.train.Int64List(value=label))}}))
-                        # 序列化
-                        serialized = example.SerializeToString()
-                        writer.write(serialized)
-                    logger.info(f'保存{{filename}}成功')
-                    writer.close()
-                else:
-                    return None
+        with tf.io.TFRecordWriter(temp_filename) as writer:
+            for image, label in zip(datasets, labels):
+                writer.write(WriteTFRecord.serialize(image, label, mode=mode, image_format=image_format))
+                number = number + 1
+                if number % report_freq == 0:
+                    WriteTFRecord.report_progress(report_freq)
+        WriteTFRecord.report_progress(number % report_freq)
+        os.replace(temp_filename, filename)
+        return os.path.basename(filename), number
+
+    @staticmethod
+    def report_progress(number):
+        if pack_counter is not None and number:
+            with pack_counter.get_lock():
+                pack_counter.value += number
+
+    @staticmethod
+    def write_shards(shards: list, desc, mode=MODE, workers=PACK_WORKERS, image_format=PACK_FORMAT):
+        # shards为[(分片文件名, 图片, 标签)],用多进程并行编码,每个进程写自己的分片,返回[(分片文件名, 图片数)]
+        if not shards:
+            return []
+        # spawn启动的进程不继承父进程的TensorFlow状态,linux和windows的行为一致
+        context = multiprocessing.get_context('spawn')
+        counter = context.Value('q', 0)
+        with ProcessPoolExecutor(max_workers=max(min(workers or os.cpu_count(), len(shards)), 1), mp_context=context,
+                                 initializer=init_pack_worker, initargs=(counter,)) as executor:
+            futures = [executor.submit(WriteTFRecord.write_shard, filename, images, shard_labels, mode, image_format)
+                       for filename, images, shard_labels in shards]
+            with tqdm(total=sum([len(images) for filename, images, shard_labels in shards]), desc=desc) as bar:
+                while wait(futures, timeout=1)[1]:
+                    bar.update(counter.value - bar.n)
+                bar.update(counter.value - bar.n)
+            return [future.result() for future in futures]
+
+    @staticmethod
+    def write_manifest(TFRecord_path, file_name, shards: list, mode=MODE, image_format=PACK_FORMAT, update=None):
+        # 记录每个分片的文件名和图片数以及这次新增、修改、删除的图片数,删除不再使用的分片
+        names = [name for name, number in shards]
+        for name in os.listdir(TFRecord_path):
+            if name.startswith(file_name) and name.endswith('.tfrecords') and name not in names:
+                os.remove(os.path.join(TFRecord_path, name))
+        manifest = {{'name': file_name, 'mode': mode, 'format': image_format, 'label': 'index',
+                    'count': sum([number for name, number in shards]),
+                    'shards': [{{'name': name, 'count': number}} for name, number in shards], 'update': update or {{}}}}
+        with open(os.path.join(TFRecord_path, 'manifest.json'), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    @staticmethod
+    def write_index(TFRecord_path, index: dict):
+        # images.json记录每张图片的大小、修改时间、内容哈希和所在的分片,图片多时很大,不缩进,先写临时文件再改名
+        filename = os.path.join(TFRecord_path, 'images.json')
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps(index, ensure_ascii=False, separators=(',', ':')))
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def file_hash(image):
+        with open(image, 'rb') as f:
+            return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def shard_number(name, file_name):
+        number = name[len(file_name):-len('.tfrecords')]
+        return int(number) if number.isdigit() else 0
+
+    @staticmethod
+    def WriteTFRecord(TFRecord_path, datasets: list, labels: list, file_name='dataset', spilt=PACK_SHARD_SIZE,
+                      mode=MODE, workers=PACK_WORKERS, image_format=PACK_FORMAT, incremental=PACK_INCREMENTAL):
+        # 增量打包: 按images.json对比每张图片的大小和修改时间,有变化时再对比内容哈希
+        # 新增和修改的图片每spilt张编码成一个新分片,删除和修改的图片所在的旧分片用剩下的图片重新编码,其他分片不动
+        # incremental为False、没有images.json或者mode、图片格式、标签格式和上次不一致时全部重新打包
+        if len(datasets) != len(labels):
+            raise ValueError(f'图片数{{len(datasets)}}和标签数{{len(labels)}}不一致')
+        if not os.path.exists(TFRecord_path):
+            os.mkdir(TFRecord_path)
+        logger.info(f'文件个数为:{{len(datasets)}}')
+        manifest = pack_manifest(TFRecord_path)
+        index = {{}}
+        if incremental and (manifest.get('mode'), manifest.get('format'), manifest.get('label')) == (
+                mode, image_format, 'index'):
+            index = pack_index(TFRecord_path)
+        if not index:
+            manifest = {{}}
+            logger.info(f'{{TFRecord_path}}全部重新打包')
+        images = dict((os.path.relpath(image), (image, label)) for image, label in zip(datasets, labels))
+        kept, candidates = {{}}, []
+        for key, (image, label) in images.items():
+            stat = os.stat(image)
+            entry = index.get(key)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                kept[key] = entry
+            else:
+                candidates.append((key, {{'size': stat.st_size, 'mtime': stat.st_mtime}}))
+        # 只有大小或修改时间变了的图片才计算哈希,内容没变时只更新记录
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            hashes = list(executor.map(WriteTFRecord.file_hash, [images[key][0] for key, entry in candidates]))
+        added, stale, changed = [], set(), 0
+        for (key, entry), digest in zip(candidates, hashes):
+            old_entry = index.get(key)
+            if old_entry and old_entry['hash'] == digest:
+                kept[key] = dict(old_entry, **entry)
+                continue
+            if old_entry:
+                stale.add(old_entry['shard'])
+                changed = changed + 1
+            added.append((key, dict(entry, hash=digest)))
+        removed = [key for key in index if key not in images]
+        stale.update([index[key]['shard'] for key in removed])
+        if index and not added and not stale:
+            WriteTFRecord.write_index(TFRecord_path, kept)
+            logger.info(f'{{TFRecord_path}}没有新增、修改或删除的图片')
+            return [(shard['name'], shard['count']) for shard in manifest['shards']]
+        members = collections.defaultdict(list)
+        for key, entry in kept.items():
+            members[entry['shard']].append(key)
+        shards = [(os.path.join(TFRecord_path, name), [images[key][0] for key in members[name]],
+                   [images[key][1] for key in members[name]]) for name in sorted(stale) if members[name]]
+        start_number = max([WriteTFRecord.shard_number(shard['name'], file_name) for shard in
+                            manifest.get('shards', [])], default=0) + 1
+        for number, start in enumerate(range(0, len(added), spilt)):
+            name = f'{{file_name}}{{start_number + number}}.tfrecords'
+            keys = [key for key, entry in added[start:start + spilt]]
+            for key, entry in added[start:start + spilt]:
+                kept[key] = dict(entry, shard=name)
+            shards.append((os.path.join(TFRecord_path, name), [images[key][0] for key in keys],
+                           [images[key][1] for key in keys]))
+        WriteTFRecord.write_shards(shards, f'正在打包{{file_name}}', mode=mode, workers=workers, image_format=image_format)
+        counts = collections.Counter([entry['shard'] for entry in kept.values()])
+        shards = [(name, counts[name]) for name in sorted(counts, key=lambda name: WriteTFRecord.shard_number(
+            name, file_name))]
+        update = {{'added': len(added) - changed, 'changed': changed, 'removed': len(removed),
+                  'rewritten': len([name for name in stale if members[name]])}}
+        WriteTFRecord.write_index(TFRecord_path, kept)
+        WriteTFRecord.write_manifest(TFRecord_path, file_name, shards, mode=mode, image_format=image_format,
+                                     update=update)
+        logger.info(f'{{TFRecord_path}}打包完成,共{{len(shards)}}个分片,新增{{update["added"]}}张,修改{{update["changed"]}}张,'
+                    f'删除{{update["removed"]}}张,重新编码{{update["rewritten"]}}个旧分片')
+        return shards
+
+
+# 打包目录的manifest.json,没有时返回空字典
+def pack_manifest(path):
+    manifest_file = os.path.join(path, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return {{}}
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+
+# 打包目录的images.json,每张图片的记录,没有时返回空字典
+def pack_index(path):
+    index_file = os.path.join(path, 'images.json')
+    if not os.path.exists(index_file):
+        return {{}}
+    with open(index_file, 'r', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+
+# 打包好的TFRecord分片,有manifest.json时按manifest读取,否则为目录下所有的.tfrecords文件
+def tfrecord_files(path):
+    manifest = pack_manifest(path)
+    if manifest:
+        return [os.path.join(path, shard['name']) for shard in manifest['shards']]
+    return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.tfrecords')]
+
+
+# 按manifest.json记录的图片格式和标签格式解析分片,类别数在这里读一次
+# 以前打包的分片没有记录,为JPEG图片和one-hot的浮点数标签,不用重新打包也能继续训练
+# batch为True时返回parse_batch_function,数据集要先batch再map
+def pack_parse_function(path, mode=MODE, batch=False):
+    manifest = pack_manifest(path)
+    image_format = manifest.get('format', 'jpeg')
+    label_format = manifest.get('label', 'one_hot')
+    num_classes = vocabulary_size()
+    function = parse_batch_function if batch else parse_function
+    return lambda exam_proto: function(exam_proto, mode=mode, image_format=image_format, label_format=label_format,
+                                       num_classes=num_classes)
+
+
+# 磁盘缓存的文件名带上manifest.json的修改时间,重新打包后不会读到旧的缓存,旧的缓存文件直接删除
+def dataset_cache_file(path):
+    manifest = os.path.join(path, 'manifest.json')
+    name = os.path.basename(path)
+    version = int(os.path.getmtime(manifest)) if os.path.exists(manifest) else 0
+    if not os.path.exists(dataset_cache_path):
+        os.mkdir(dataset_cache_path)
+    for cache in os.listdir(dataset_cache_path):
+        if cache.startswith(f'{{name}}-') and not cache.startswith(f'{{name}}-{{version}}.'):
+            os.remove(os.path.join(dataset_cache_path, cache))
+    return os.path.join(dataset_cache_path, f'{{name}}-{{version}}')
+
+
+# 训练和验证的数据管道: 不缓存时训练集先打乱分片的顺序,interleave同时读取cycle_length个分片,先batch再批量解析
+# 解码后按cache缓存('memory' | 'disk' | None),以后每轮不用再读取和解码,缓存之后分片的顺序固定,打乱只靠shuffle_buffer
+# 训练集再拆成单条,按echo回显、在shuffle_buffer里打乱后重新组成batch,并行度和prefetch都交给AUTOTUNE
+def build_dataset(path, training=True, batch_size=BATCH_SIZE, mode=MODE, cache=DATASET_CACHE,
+                  shuffle_buffer=SHUFFLE_BUFFER_SIZE, cycle_length=INTERLEAVE_CYCLE, echo=DATA_ECHO):
+    autotune = tf.data.experimental.AUTOTUNE
+    files = tfrecord_files(path)
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if training:
+        if not cache:
+            dataset = dataset.shuffle(len(files), reshuffle_each_iteration=True)
+        options = tf.data.Options()
+        options.experimental_deterministic = False
+        dataset = dataset.with_options(options)
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=max(min(cycle_length, len(files)), 1),
+                                 num_parallel_calls=autotune)
+    dataset = dataset.batch(batch_size).map(pack_parse_function(path, mode=mode, batch=True),
+                                            num_parallel_calls=autotune)
+    if cache == 'disk':
+        dataset = dataset.cache(dataset_cache_file(path))
+    elif cache == 'memory':
+        dataset = dataset.cache()
+    elif cache:
+        raise ValueError(f'没有cache={{cache}}的缓存方式')
+    if training:
+        dataset = dataset.unbatch()
+        if echo > 1:
+            dataset = dataset.flat_map(lambda *example: tf.data.Dataset.from_tensors(example).repeat(echo))
+        if shuffle_buffer > 1:
+            dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+    return dataset.prefetch(autotune)
+
+
+# 解码打包的图片,打包时已经填充到IMAGE_HEIGHT×IMAGE_WIDTH,raw格式不用解码,大小一致时不再缩放
+def decode_pack_image(image, image_format=PACK_FORMAT):
+    if image_format == 'raw':
+        return tf.reshape(tf.io.decode_raw(image, tf.uint8), [IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNALS])
+    if image_format == 'png':
+        img_tensor = tf.image.decode_png(image, channels=IMAGE_CHANNALS)
+    else:
+        img_tensor = tf.image.decode_jpeg(image, channels=IMAGE_CHANNALS)
+    img_tensor = tf.cond(tf.reduce_all(tf.equal(tf.shape(img_tensor)[:2], [IMAGE_HEIGHT, IMAGE_WIDTH])),
+                         lambda: tf.cast(img_tensor, tf.float32),
+                         lambda: tf.image.resize(img_tensor, [IMAGE_HEIGHT, IMAGE_WIDTH]))
+    return tf.ensure_shape(img_tensor, [IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNALS])
+
+
+# 批量解码,raw格式整个batch一次还原,JPEG和PNG在计算图里逐张解码
+def decode_pack_images(images, image_format=PACK_FORMAT):
+    if image_format == 'raw':
+        return tf.reshape(tf.io.decode_raw(images, tf.uint8), [-1, IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNALS])
+    return tf.map_fn(lambda image: decode_pack_image(image, image_format=image_format), images, dtype=tf.float32)
+
+
+# 映射表的类别数,构建数据管道时读一次,不在每次解析时打开num_classes.json
+def vocabulary_size(num_classes=n_class_file):
+    with open(num_classes, 'r', encoding='utf-8') as f:
+        return len(json.loads(f.read()))
+
+
+# 分片里每条记录的特征,label_format为'index'时标签为下标,为'one_hot'时为以前打包的浮点数标签
+def pack_features(mode=MODE, label_format='index', num_classes=None):
+    if mode == 'ORDINARY':
+        if label_format == 'index':
+            label_feature = tf.io.FixedLenFeature([CAPTCHA_LENGTH], tf.int64)
         else:
-            num_count = len(datasets)
-            labels_count = len(labels)
-            if not os.path.exists(TFRecord_path):
-                os.mkdir(TFRecord_path)
-            logger.info(f'文件个数为:{{num_count}}')
-            logger.info(f'标签个数为:{{labels_count}}')
-            while True:
-                if datasets:
-                    number = number + 1
-                    image_list = datasets[:spilt]
-                    label_list = labels[:spilt]
-                    for i in image_list:
-                        datasets.remove(i)
-                    for i in label_list:
-                        labels.remove(i)
-                    filename = file_name + str(number) + '.tfrecords'
-                    filename = os.path.join(TFRecord_path, filename)
-                    writer = tf.io.TFRecordWriter(filename)
-                    logger.info(f'开始保存{{filename}}')
-                    for image, label in zip(image_list, label_list):
-                        num_count = num_count - 1
-                        image_bytes = WriteTFRecord.pad_image(image)
-                        logger.debug(f'剩余{{num_count}}图片待打包')
-                        example = tf.train.Example(
-                            features=tf.train.Features(
-                                feature={{'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_bytes])),
-                                         'label': tf.train.Feature(float_list=tf.train.FloatList(value=label))}}))
-                        # 序列化
-                        serialized = example.SerializeToString()
-                        writer.write(serialized)
-                    logger.info(f'保存{{filename}}成功')
-                    writer.close()
-                else:
-                    return None
+            label_feature = tf.io.FixedLenFeature([CAPTCHA_LENGTH, num_classes + 1], tf.float32)
+    elif mode == 'NUM_CLASSES':
+        if label_format == 'index':
+            label_feature = tf.io.FixedLenFeature([], tf.int64)
+        else:
+            label_feature = tf.io.FixedLenFeature([num_classes], tf.float32)
+    elif mode == 'CTC':
+        label_feature = tf.io.VarLenFeature(tf.int64)
+    else:
+        raise ValueError(f'没有mode={{mode}}映射的方法')
+    return {{'image': tf.io.FixedLenFeature([], tf.string), 'label': label_feature}}
+
+
+# 把下标标签展开成one-hot,ORDINARY多一类空白;CTC的标签保持下标
+def expand_label(label_tensor, mode=MODE, label_format='index', num_classes=None):
+    if label_format != 'index' or mode == 'CTC':
+        return label_tensor
+    return tf.one_hot(label_tensor, depth=num_classes + 1 if mode == 'ORDINARY' else num_classes)
 
 
 # 映射函数
-def parse_function(exam_proto, mode=MODE):
+def parse_function(exam_proto, mode=MODE, image_format=PACK_FORMAT, label_format='index', num_classes=None):
+    if num_classes is None:
+        num_classes = vocabulary_size()
+    parsed_example = tf.io.parse_single_example(exam_proto, pack_features(mode, label_format, num_classes))
+    img_tensor = decode_pack_image(parsed_example['image'], image_format=image_format)
+    img_tensor = tf.cast(img_tensor, tf.float32) / 255.
+    label_tensor = expand_label(parsed_example['label'], mode, label_format, num_classes)
+    return (img_tensor, label_tensor)
+
+
+# 批量映射函数,在batch之后使用,一次parse_example解析整个batch
+def parse_batch_function(exam_protos, mode=MODE, image_format=PACK_FORMAT, label_format='index', num_classes=None):
+    if num_classes is None:
+        num_classes = vocabulary_size()
+    parsed_example = tf.io.parse_example(exam_protos, pack_features(mode, label_format, num_classes))
+    img_tensor = decode_pack_images(parsed_example['image'], image_format=image_format)
+    img_tensor = tf.cast(img_tensor, tf.float32) / 255.
+    label_tensor = expand_label(parsed_example['label'], mode, label_format, num_classes)
+    return (img_tensor, label_tensor)
+
+
+# 把parse_function解析出的标签还原成文字,和decode_vector的结果对比
+def label_text(label, num_classes, mode=MODE):
     if mode == 'ORDINARY':
-        with open(n_class_file, 'r', encoding='utf-8') as f:
-            make_dict = json.loads(f.read())
-        features = {{
-            'image': tf.io.FixedLenFeature([], tf.string),
-            'label': tf.io.FixedLenFeature([CAPTCHA_LENGTH, len(make_dict) + 1], tf.float32)
-        }}
-        parsed_example = tf.io.parse_single_example(exam_proto, features)
-        img_tensor = tf.image.decode_jpeg(parsed_example['image'], channels=IMAGE_CHANNALS)
-        img_tensor = tf.image.resize(img_tensor, [IMAGE_HEIGHT, IMAGE_WIDTH])
-        img_tensor = img_tensor / 255.
-        label_tensor = parsed_example['label']
-        return (img_tensor, label_tensor)
+        return ''.join([num_classes.get(str(i), '') for i in np.argmax(label, axis=-1)])
     elif mode == 'NUM_CLASSES':
-        with open(n_class_file, 'r', encoding='utf-8') as f:
-            make_dict = json.loads(f.read())
-        features = {{
-            'image': tf.io.FixedLenFeature([], tf.string),
-            'label': tf.io.FixedLenFeature([len(make_dict)], tf.float32)
-        }}
-        parsed_example = tf.io.parse_single_example(exam_proto, features)
-        img_tensor = tf.image.decode_jpeg(parsed_example['image'], channels=IMAGE_CHANNALS)
-        img_tensor = tf.image.resize(img_tensor, [IMAGE_HEIGHT, IMAGE_WIDTH])
-        img_tensor = img_tensor / 255.
-        label_tensor = parsed_example['label']
-        return (img_tensor, label_tensor)
-
+        return num_classes.get(str(np.argmax(label)))
     elif mode == 'CTC':
-        features = {{
-            'image': tf.io.FixedLenFeature([], tf.string),
-            'label': tf.io.VarLenFeature(tf.int64)
-        }}
-        parsed_example = tf.io.parse_single_example(exam_proto, features)
-        img_tensor = tf.image.decode_jpeg(parsed_example['image'], channels=IMAGE_CHANNALS)
-        img_tensor = tf.image.resize(img_tensor, [IMAGE_HEIGHT, IMAGE_WIDTH])
-        img_tensor = img_tensor / 255.
-        label_tensor = parsed_example['label']
-        return (img_tensor, label_tensor)
+        return ''.join([num_classes.get(str(i), '') for i in label.values.numpy()])
     else:
         raise ValueError(f'没有mode={{mode}}映射的方法')
 
 
+# 手写的Prometheus指标,不依赖prometheus_client,render输出/metrics接口的文本格式
+class Metrics(object):
+    # 耗时直方图的桶(秒)
+    latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 指标名: (类型, 说明, 直方图的桶, {{标签: 值}})
+        self.metrics = collections.OrderedDict()
+        # 指标名: (说明, 读取即时值的函数)
+        self.gauges = collections.OrderedDict()
+
+    def histogram(self, name, help_text, buckets=latency_buckets):
+        self.metrics[name] = ('histogram', help_text, tuple(buckets), {{}})
+
+    def counter(self, name, help_text):
+        self.metrics[name] = ('counter', help_text, None, {{}})
+
+    def gauge(self, name, help_text, function):
+        self.gauges[name] = (help_text, function)
+
+    def inc(self, name, labels=None, value=1):
+        values = self.metrics[name][3]
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        buckets, values = self.metrics[name][2:]
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            if key not in values:
+                values[key] = [[0] * len(buckets), 0., 0]
+            counts = values[key]
+            # 桶是累计的,value落在所有不小于它的桶里
+            for index, bucket in enumerate(buckets):
+                if value <= bucket:
+                    counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def request(self, return_code, seconds):
+        # 记录一次请求的return_code和总耗时
+        self.inc('captcha_requests_total', {{'return_code': return_code}})
+        self.observe('captcha_request_seconds', seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        # 记录with代码块的耗时到captcha_stage_seconds
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('captcha_stage_seconds', time.perf_counter() - start_time, {{'stage': stage}})
+
+    @staticmethod
+    def format_labels(key):
+        if not key:
+            return ''
+        return '{{' + ','.join(f'{{name}}="{{value}}"' for name, value in key) + '}}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets, values) in self.metrics.items():
+                lines.append(f'# HELP {{name}} {{help_text}}')
+                lines.append(f'# TYPE {{name}} {{kind}}')
+                for key, value in sorted(values.items()):
+                    if kind == 'counter':
+                        lines.append(f'{{name}}{{self.format_labels(key)}} {{value}}')
+                        continue
+                    counts, total, count = value
+                    for bucket, bucket_count in zip(buckets + ('+Inf',), counts + [count]):
+                        lines.append(f'{{name}}_bucket{{self.format_labels(key + (("le", bucket),))}} {{bucket_count}}')
+                    lines.append(f'{{name}}_sum{{self.format_labels(key)}} {{total}}')
+                    lines.append(f'{{name}}_count{{self.format_labels(key)}} {{count}}')
+        for name, (help_text, function) in self.gauges.items():
+            lines.append(f'# HELP {{name}} {{help_text}}')
+            lines.append(f'# TYPE {{name}} gauge')
+            lines.append(f'{{name}} {{function()}}')
+        return '\\n'.join(lines) + '\\n'
+
+
+metrics = Metrics()
+metrics.histogram('captcha_stage_seconds', '各阶段的耗时(秒),base64_decode和forward、postprocess按请求和batch统计,'
+                                           'image_decode和queue_wait按图片统计')
+metrics.histogram('captcha_request_seconds', '请求的总耗时(秒)')
+metrics.counter('captcha_requests_total', '按return_code统计的请求数')
+metrics.histogram('captcha_batch_size', '每次前向计算的batch大小', buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+metrics.counter('captcha_cascade_images_total', '级联预测时每个模型预测的图片数')
+metrics.counter('captcha_shed_total', '过载保护丢弃的请求数,reason为queue_full或deadline')
+
+
+# CTC解码,整个batch一起解码,空白字符为最后一类(和CTCLoss的blank_index=-1一致)
+# beam_width为1时用贪心解码,大于1时用beam search,返回下标(不足的位置填-1)和每条序列的对数概率
+def ctc_decode_index(vector, beam_width=CTC_BEAM_WIDTH):
+    vector = tf.nn.log_softmax(tf.cast(vector, tf.float32))
+    inputs = tf.transpose(vector, perm=[1, 0, 2])
+    sequence_length = tf.fill([tf.shape(vector)[0]], tf.shape(vector)[1])
+    if beam_width > 1:
+        decoded, log_probability = tf.nn.ctc_beam_search_decoder(inputs, sequence_length, beam_width=beam_width,
+                                                                 top_paths=1)
+        log_probability = log_probability[:, 0]
+    else:
+        decoded, neg_sum_logits = tf.nn.ctc_greedy_decoder(inputs, sequence_length)
+        log_probability = -neg_sum_logits[:, 0]
+    index = tf.sparse.to_dense(decoded[0], default_value=-1)
+    return index, log_probability
+
+
 class Predict_Image(object):
-    def __init__(self, model=None, image=None, num_classes=str, mode=MODE):
+    # 批量解码图片的线程池
+    decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+
+    def __init__(self, model=None, image=None, num_classes=str, mode=MODE, image_size=(IMAGE_HEIGHT, IMAGE_WIDTH)):
         self.model = model
         self.image = image
         self.num_classes = num_classes
         self.mode = mode
+        # 模型输入的(高, 宽),多模型服务时每个模型可以不一样
+        self.image_size = image_size
 
     def decode_image(self, image):
+        image_height, image_width = self.image_size
         try:
             with open(image, 'rb') as image_file:
                 image = Image.open(image_file)
@@ -913,17 +2177,17 @@ class Predict_Image(object):
                     image = image.convert('RGB')
                 while True:
                     width, height = image.size
-                    if IMAGE_HEIGHT < height:
-                        resize_width = int(IMAGE_HEIGHT / height * width)
-                        image = image.resize((resize_width, IMAGE_HEIGHT))
-                    if IMAGE_WIDTH < width:
-                        resize_height = int(IMAGE_WIDTH / width * height)
-                        image = image.resize((IMAGE_WIDTH, resize_height))
-                    if IMAGE_WIDTH >= width and IMAGE_HEIGHT >= height:
+                    if image_height < height:
+                        resize_width = int(image_height / height * width)
+                        image = image.resize((resize_width, image_height))
+                    if image_width < width:
+                        resize_height = int(image_width / width * height)
+                        image = image.resize((image_width, resize_height))
+                    if image_width >= width and image_height >= height:
                         break
                 width, height = image.size
                 image = np.array(image)
-                image = np.pad(image, ((0, IMAGE_HEIGHT - height), (0, IMAGE_WIDTH - width), (0, 0)), 'constant',
+                image = np.pad(image, ((0, image_height - height), (0, image_width - width), (0, 0)), 'constant',
                                constant_values=0)
                 image = np.expand_dims(image, axis=0)
                 image = image / 255.
@@ -937,17 +2201,17 @@ class Predict_Image(object):
                     image = image.convert('RGB')
                 while True:
                     width, height = image.size
-                    if IMAGE_HEIGHT < height:
-                        resize_width = int(IMAGE_HEIGHT / height * width)
-                        image = image.resize((resize_width, IMAGE_HEIGHT))
-                    if IMAGE_WIDTH < width:
-                        resize_height = int(IMAGE_WIDTH / width * height)
-                        image = image.resize((IMAGE_WIDTH, resize_height))
-                    if IMAGE_WIDTH >= width and IMAGE_HEIGHT >= height:
+                    if image_height < height:
+                        resize_width = int(image_height / height * width)
+                        image = image.resize((resize_width, image_height))
+                    if image_width < width:
+                        resize_height = int(image_width / width * height)
+                        image = image.resize((image_width, resize_height))
+                    if image_width >= width and image_height >= height:
                         break
                 width, height = image.size
                 image = np.array(image)
-                image = np.pad(image, ((0, IMAGE_HEIGHT - height), (0, IMAGE_WIDTH - width), (0, 0)), 'constant',
+                image = np.pad(image, ((0, image_height - height), (0, image_width - width), (0, 0)), 'constant',
                                constant_values=0)
                 image = np.expand_dims(image, axis=0)
                 image = image / 255.
@@ -961,10 +2225,11 @@ class Predict_Image(object):
         label = re.split('_', label)[0]
         return label
 
-    def recognition_probability(self, recognition_rate_liat):
-        mean_section = np.mean(recognition_rate_liat)
-        std_section = np.std(recognition_rate_liat)
-        sqrt_section = np.sqrt(len(recognition_rate_liat))
+    def recognition_probability(self, recognition_rate_liat, axis=None):
+        # axis为-1时对整个batch的每一行分别计算
+        mean_section = np.mean(recognition_rate_liat, axis=axis)
+        std_section = np.std(recognition_rate_liat, axis=axis)
+        sqrt_section = np.sqrt(np.shape(recognition_rate_liat)[-1])
         min_confidence = mean_section - (2.58 * (std_section / sqrt_section))
         return min_confidence
 
@@ -992,20 +2257,46 @@ class Predict_Image(object):
             recognition_rate = np.max(vector) / np.sum(np.abs(vector))
             return text, recognition_rate
         elif self.mode == 'CTC':
-            vector = vector[0]
-            for i in vector:
-                text = num_classes.get(str(np.argmax(i)))
-                if text:
-                    text_list.append(text)
-            text = ''.join(text_list)
-            for i in vector:
-                recognition_rate = np.max(i) / np.sum(np.abs(i))
-                recognition_rate_liat.append(recognition_rate)
-            recognition_rate = self.recognition_probability(recognition_rate_liat)
+            index, log_probability = ctc_decode_index(vector[:1])
+            text = ''.join([num_classes.get(str(i), '') for i in index.numpy()[0] if i >= 0])
+            recognition_rate = float(np.exp(log_probability.numpy()[0]))
             return text, recognition_rate
         else:
             raise ValueError(f'还没写{{self.mode}}这种预测方法')
 
+    def decode_vectors(self, vectors, num_classes):
+        # 批量解码,vectors的第一维为batch,映射表只读一次,argmax和识别率对整个batch一起计算
+        # 只有按下标查字符拼成结果是逐张的,返回每张图片的(结果,识别率)
+        with open(num_classes, 'r', encoding='utf-8') as f:
+            num_classes = json.loads(f.read())
+        if self.mode == 'ORDINARY':
+            vectors = np.asarray(vectors)
+            indexes = np.argmax(vectors, axis=-1)
+            rates = np.max(vectors, axis=-1) / np.sum(np.abs(vectors), axis=-1)
+            recognition_rates = self.recognition_probability(rates, axis=-1)
+            return [(''.join([num_classes.get(str(i), '') for i in row]), recognition_rate) for row, recognition_rate
+                    in zip(indexes, recognition_rates)]
+        elif self.mode == 'NUM_CLASSES':
+            vectors = np.asarray(vectors)
+            indexes = np.argmax(vectors, axis=-1)
+            recognition_rates = np.max(vectors, axis=-1) / np.sum(np.abs(vectors), axis=-1)
+            return [(num_classes.get(str(i)), recognition_rate) for i, recognition_rate in
+                    zip(indexes, recognition_rates)]
+        elif self.mode == 'CTC':
+            index, log_probability = ctc_decode_index(vectors)
+            return [(''.join([num_classes.get(str(i), '') for i in row if i >= 0]), float(np.exp(probability))) for
+                    row, probability in zip(index.numpy(), log_probability.numpy())]
+        else:
+            raise ValueError(f'还没写{{self.mode}}这种预测方法')
+
+    def timed_decode_image(self, image):
+        with metrics.timer('image_decode'):
+            return self.decode_image(image)
+
+    def decode_images(self, images: list):
+        # 并行解码多张图片,解码失败的位置为None
+        return list(self.decode_executor.map(self.timed_decode_image, images))
+
     def predict_image(self):
         global right_value
         global predicted_value
@@ -1042,6 +2333,829 @@ class Predict_Image(object):
         times = end_time - start_time
         return (result, recognition_rate, times)
 
+    def api_batch(self, batch_predict, result_cache=None, encoded=True, deadline=None):
+        # self.image为base64的列表(encoded=False时为图片原始字节),解码成功的图片合并成一个batch做一次前向计算,按原顺序返回
+        # 等待的图片加上这个请求的图片超过队列上限或者解码完已经超过deadline时抛出Request_Shed
+        start_time = time.time()
+        batch_predict.admit(deadline, len(self.image))
+        with metrics.timer('base64_decode'):
+            image_bytes = [base64.b64decode(i) for i in self.image] if encoded else self.image
+        results = [result_cache.lookup(image) if result_cache else None for image in image_bytes]
+        miss_list = [index for index, result in enumerate(results) if result is None]
+        results = [(False, 0) if result is None else result for result in results]
+        images = [image_bytes[index] for index in miss_list]
+        if not batch_predict.input_bytes:
+            images = batch_predict.decoder().decode_images(images)
+        index_list = [index for index, image in zip(miss_list, images) if image is not None]
+        images = [image for image in images if image is not None]
+        if index_list:
+            vectors = batch_predict.predict_batch(images, deadline)
+            for index, result in zip(index_list, vectors):
+                if not isinstance(result, Exception):
+                    results[index] = result
+                    if result_cache:
+                        result_cache.store(image_bytes[index], result)
+        end_time = time.time()
+        times = end_time - start_time
+        return (results, times)
+
+
+# 固定输入签名的推理函数,避免model.predict每次调用都重建数据适配器,启动时按batch分桶预热
+class Inference_Model(object):
+    def __init__(self, model, batch_sizes=WARMUP_BATCH_SIZES):
+        self.model = model
+        self.batch_sizes = sorted(batch_sizes)
+        # 输入大小以模型为准,多模型服务时每个模型可以不一样
+        input_shape = tuple(model.input_shape[1:])
+        self.input_shape = input_shape if None not in input_shape else (IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNALS)
+        self.image_size = self.input_shape[:2]
+        self.function = tf.function(self.call, input_signature=[
+            tf.TensorSpec(shape=(None,) + self.input_shape, dtype=tf.float32)])
+
+    def call(self, images):
+        return self.model(images, training=False)
+
+    def warmup(self):
+        start_time = time.time()
+        for batch_size in self.batch_sizes:
+            self.function(tf.zeros((batch_size,) + self.input_shape, dtype=tf.float32))
+        logger.info(f'模型预热完成,预热的batch为{{self.batch_sizes}},耗时{{time.time() - start_time}}s')
+        return self
+
+    def bucket(self, batch_size):
+        # 向上取最近的预热过的batch大小,超出时按原大小预测
+        for size in self.batch_sizes:
+            if size >= batch_size:
+                return size
+        return batch_size
+
+    def predict(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        batch_size = len(images)
+        pad_size = self.bucket(batch_size) - batch_size
+        if pad_size:
+            images = np.concatenate([images, np.zeros((pad_size,) + images.shape[1:], dtype=np.float32)], axis=0)
+        return self.function(tf.constant(images)).numpy()[:batch_size]
+
+    predict_on_batch = predict
+
+
+# 预测时不起作用的层(噪声、dropout、DropBlock),导出只用于预测的模型时换成恒等映射
+def inference_identity_layer(layer):
+    return isinstance(layer, (tf.keras.layers.GaussianNoise, tf.keras.layers.GaussianDropout,
+                              tf.keras.layers.AlphaDropout, tf.keras.layers.Dropout)) or \\
+           layer.__class__.__name__ == 'DropBlock'
+
+
+# 把BatchNormalization折叠进前面的卷积,返回卷积的新权重[kernel, bias]
+def fold_batch_normalization(conv, bn):
+    weights = conv.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if conv.use_bias else 0.
+    gamma = bn.gamma.numpy() if bn.gamma is not None else 1.
+    beta = bn.beta.numpy() if bn.beta is not None else 0.
+    scale = gamma / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+    if isinstance(conv, tf.keras.layers.DepthwiseConv2D):
+        # DepthwiseConv2D的输出通道为in_channels * depth_multiplier
+        kernel = kernel * scale.reshape(kernel.shape[2], kernel.shape[3])
+    else:
+        kernel = kernel * scale
+    bias = (bias - bn.moving_mean.numpy()) * scale + beta
+    return [kernel, bias.astype(kernel.dtype)]
+
+
+# 只用于预测的模型: 去掉噪声、dropout和DropBlock,把紧跟在卷积后面的BatchNormalization折叠进卷积的权重
+# 常量折叠由TensorFlow的图优化(grappler)在tf.function和SavedModel里完成
+def optimize_inference_model(model):
+    config = model.get_config()
+    layers = dict((layer.name, layer) for layer in model.layers)
+    # 每一层的输出被哪些层用到
+    consumers = collections.defaultdict(list)
+    for layer_config in config['layers']:
+        for node in layer_config['inbound_nodes']:
+            for inbound in node:
+                consumers[inbound[0]].append(layer_config['name'])
+    # 卷积名: 折叠进这个卷积的BatchNormalization名
+    folds = {{}}
+    for layer_config in config['layers']:
+        bn = layers[layer_config['name']]
+        if not isinstance(bn, tf.keras.layers.BatchNormalization) or len(layer_config['inbound_nodes']) != 1:
+            continue
+        node = layer_config['inbound_nodes'][0]
+        conv = layers[node[0][0]] if len(node) == 1 else None
+        # 只折叠没有激活函数的普通卷积和DepthwiseConv2D,并且卷积的输出只给这个BatchNormalization用
+        if isinstance(conv, tf.keras.layers.Conv2D) and not isinstance(conv, tf.keras.layers.Conv2DTranspose) and \\
+                conv.get_config()['activation'] == 'linear' and conv.data_format == 'channels_last' and \\
+                list(bn.axis) in ([3], [-1]) and consumers[conv.name] == [bn.name]:
+            folds[conv.name] = bn.name
+    identity_names = set(folds.values()) | set(layer.name for layer in model.layers if inference_identity_layer(layer))
+
+    def clone_layer(layer):
+        if layer.name in identity_names:
+            return tf.keras.layers.Activation('linear', name=layer.name)
+        layer_config = layer.get_config()
+        if layer.name in folds:
+            layer_config['use_bias'] = True
+        return layer.__class__.from_config(layer_config)
+
+    optimized = tf.keras.models.clone_model(model, clone_function=clone_layer)
+    for layer in optimized.layers:
+        if layer.name in folds:
+            layer.set_weights(fold_batch_normalization(layers[layer.name], layers[folds[layer.name]]))
+        elif layer.weights:
+            layer.set_weights(layers[layer.name].get_weights())
+    logger.info(f'折叠了{{len(folds)}}个BatchNormalization,去掉了{{len(identity_names) - len(folds)}}个噪声和dropout层')
+    return optimized
+
+
+# 对比原模型和optimize_inference_model的输出误差和CPU上单张图片的耗时(毫秒)
+def compare_inference_model(model, optimized, images, repeat=50):
+    max_error = float(np.max(np.abs(model(images, training=False).numpy() - optimized(images, training=False).numpy())))
+    latency = []
+    with tf.device('/CPU:0'):
+        for inference_model in (Inference_Model(model, batch_sizes=[1]), Inference_Model(optimized, batch_sizes=[1])):
+            inference_model.warmup()
+            start_time = time.perf_counter()
+            for _ in range(repeat):
+                inference_model.predict(images[:1])
+            latency.append((time.perf_counter() - start_time) / repeat * 1000)
+    return {{'max_error': max_error, 'latency_ms': latency[0], 'optimized_latency_ms': latency[1]}}
+
+
+# 图片预处理写进计算图: 解码 -> 等比缩小 -> 右下补0 -> 归一化,和decode_image的处理一致
+def preprocess_image_bytes(image_bytes):
+    image = tf.io.decode_image(image_bytes, channels=IMAGE_CHANNALS, expand_animations=False)
+    height = tf.cast(tf.shape(image)[0], tf.float32)
+    width = tf.cast(tf.shape(image)[1], tf.float32)
+    scale = tf.minimum(tf.minimum(IMAGE_HEIGHT / height, IMAGE_WIDTH / width), 1.)
+    size = tf.cast(tf.stack([height * scale, width * scale]), tf.int32)
+    image = tf.cond(scale < 1.,
+                    lambda: tf.round(tf.clip_by_value(tf.image.resize(image, size, method='bicubic'), 0., 255.)),
+                    lambda: tf.cast(image, tf.float32))
+    image = tf.image.pad_to_bounding_box(image, 0, 0, IMAGE_HEIGHT, IMAGE_WIDTH)
+    return image / 255.
+
+
+# 计算图版的recognition_probability,rates的最后一维为每个字符的识别率
+def recognition_probability_tensor(rates):
+    mean_section = tf.reduce_mean(rates, axis=-1)
+    std_section = tf.math.reduce_std(rates, axis=-1)
+    sqrt_section = tf.sqrt(tf.cast(tf.shape(rates)[-1], tf.float32))
+    return mean_section - (2.58 * (std_section / sqrt_section))
+
+
+# 计算图版的decode_vector,table为下标到字符的映射表,映射表里没有的下标(空白字符)映射为空字符串
+def decode_vector_tensor(vector, table, mode=MODE):
+    vector = tf.cast(vector, tf.float32)
+    index = tf.argmax(vector, axis=-1)
+    rates = tf.reduce_max(vector, axis=-1) / tf.reduce_sum(tf.abs(vector), axis=-1)
+    if mode == 'NUM_CLASSES':
+        return table.lookup(index), rates
+    elif mode == 'ORDINARY':
+        text = tf.strings.reduce_join(table.lookup(index), axis=-1)
+        return text, recognition_probability_tensor(rates)
+    elif mode == 'CTC':
+        index, log_probability = ctc_decode_index(vector)
+        text = tf.strings.reduce_join(table.lookup(index), axis=-1)
+        return text, tf.exp(log_probability)
+    else:
+        raise ValueError(f'还没写{{mode}}这种预测方法')
+
+
+# 导出输入为图片原始字节的SavedModel,预处理在TensorFlow的线程池里完成,不占用Python的GIL
+# 传入num_classes时把映射表和解码也写进计算图,直接输出识别结果result和识别率recognition_rate
+class Serving_Model(tf.Module):
+    def __init__(self, model, num_classes=None, mode=MODE):
+        super(Serving_Model, self).__init__()
+        self.model = model
+        self.mode = mode
+        self.table = None
+        if num_classes:
+            with open(num_classes, 'r', encoding='utf-8') as f:
+                num_classes = json.loads(f.read())
+            keys = tf.constant([int(key) for key in num_classes.keys()], dtype=tf.int64)
+            values = tf.constant(list(num_classes.values()), dtype=tf.string)
+            self.table = tf.lookup.StaticHashTable(tf.lookup.KeyValueTensorInitializer(keys, values),
+                                                   default_value='')
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None], dtype=tf.string)])
+    def serving(self, images):
+        images = tf.map_fn(preprocess_image_bytes, images, dtype=tf.float32)
+        vector = self.model(images, training=False)
+        if self.table is None:
+            return {{'vector': vector}}
+        result, recognition_rate = decode_vector_tensor(vector, self.table, mode=self.mode)
+        return {{'vector': vector, 'result': result, 'recognition_rate': recognition_rate}}
+
+    def save(self, path):
+        tf.saved_model.save(self, path, signatures={{'serving_default': self.serving}})
+        return path
+
+
+# save_model.py导出的TFLite模型路径,quantization为float32、float16或int8
+def tflite_file(quantization):
+    return os.path.join(model_path, f'{{os.path.splitext(MODEL_NAME)[0]}}_{{quantization}}.tflite')
+
+
+# 把keras模型转换成TFLite,quantization为float32(不量化)、float16(半精度)或int8(动态范围量化,权重为int8)
+# full_int8为全整数量化,权重和激活值都为int8,需要representative_dataset校准激活值的范围,输入输出仍为float32
+def convert_tflite(model, quantization, representative_dataset=None):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == 'full_int8':
+        if representative_dataset is None:
+            raise ValueError('全整数量化需要representative_dataset')
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization != 'float32':
+        raise ValueError(f'还没写{{quantization}}这种量化方法')
+    try:
+        return converter.convert()
+    except Exception as e:
+        # 有TFLite不支持的算子时带上TensorFlow的算子,预测时需要完整的tensorflow
+        logger.warning(f'只用TFLite内置算子转换失败,改为带上TensorFlow算子:{{e}}')
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        return converter.convert()
+
+
+# 用tf.lite.Interpreter预测,输出和keras模型一样交给decode_vector(s)解码
+# 解释器不是线程安全的,用一个解释器池支持多个线程同时预测
+class TFLite_Predict(object):
+    def __init__(self, path, pool_size=TFLITE_POOL_SIZE, num_threads=TFLITE_THREADS):
+        self.path = path
+        self.pool = queue.Queue()
+        self.interpreters = [self.interpreter(path, num_threads) for _ in range(pool_size)]
+        for interpreter in self.interpreters:
+            self.pool.put(interpreter)
+        # 一个batch分给多个解释器时每个解释器一个线程,invoke不占用GIL
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        input_detail = self.interpreters[0].get_input_details()[0]
+        self.input_shape = tuple(input_detail['shape'][1:])
+        self.image_size = self.input_shape[:2]
+
+    @staticmethod
+    def interpreter(path, num_threads):
+        try:
+            interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        except TypeError:
+            # tensorflow2.2的Interpreter没有num_threads参数
+            interpreter = tf.lite.Interpreter(model_path=path)
+        interpreter.allocate_tensors()
+        return interpreter
+
+    @staticmethod
+    def invoke(interpreter, image):
+        interpreter.set_tensor(interpreter.get_input_details()[0]['index'], image)
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+
+    def warmup(self):
+        start_time = time.time()
+        image = np.zeros((1,) + self.input_shape, dtype=np.float32)
+        for interpreter in self.interpreters:
+            self.invoke(interpreter, image)
+        logger.info(f'TFLite模型预热完成,解释器数量为{{len(self.interpreters)}},耗时{{time.time() - start_time}}s')
+        return self
+
+    def invoke_batch(self, interpreter, images):
+        # 转换出的TFLite模型输入固定为batch 1,逐张调用,不用每次改输入大小重新分配内存
+        return np.concatenate([self.invoke(interpreter, images[index:index + 1]) for index in range(len(images))],
+                              axis=0)
+
+    def predict_on_batch(self, images):
+        # 至少等到一个空闲的解释器,再拿上当前所有空闲的解释器(不超过图片数),把batch平均分给它们并行计算
+        images = np.asarray(images, dtype=np.float32)
+        interpreters = [self.pool.get()]
+        while len(interpreters) < len(images):
+            try:
+                interpreters.append(self.pool.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            if len(interpreters) == 1:
+                return self.invoke_batch(interpreters[0], images)
+            return np.concatenate(list(self.executor.map(self.invoke_batch, interpreters,
+                                                         np.array_split(images, len(interpreters)))), axis=0)
+        finally:
+            for interpreter in interpreters:
+                self.pool.put(interpreter)
+
+    predict = predict_on_batch
+
+
+# 读取Serving_Model导出的SavedModel,predict_on_batch接收图片原始字节的列表
+class Serving_Predict(object):
+    input_bytes = True
+
+    def __init__(self, path, batch_sizes=WARMUP_BATCH_SIZES):
+        self.model = tf.saved_model.load(path)
+        self.function = self.model.signatures['serving_default']
+        self.batch_sizes = sorted(batch_sizes)
+        # 导出时带了解码的模型直接输出识别结果,不需要再调用decode_vector
+        self.output_results = 'result' in self.function.structured_outputs
+
+    def warmup(self):
+        start_time = time.time()
+        image = tf.io.encode_png(tf.zeros((IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNALS), dtype=tf.uint8)).numpy()
+        for batch_size in self.batch_sizes:
+            self.predict_on_batch([image] * batch_size)
+        logger.info(f'模型预热完成,预热的batch为{{self.batch_sizes}},耗时{{time.time() - start_time}}s')
+        return self
+
+    def predict_on_batch(self, images):
+        return self.function(images=tf.constant(images))['vector'].numpy()
+
+    predict = predict_on_batch
+
+    def predict_results(self, images):
+        outputs = self.function(images=tf.constant(images))
+        return [(result.decode('utf-8'), float(recognition_rate)) for result, recognition_rate in
+                zip(outputs['result'].numpy(), outputs['recognition_rate'].numpy())]
+
+
+# 级联预测: 整个batch先用小模型预测,识别率低于threshold的图片再合并成一个batch交给大模型
+# 两个模型都接收decode_image处理后的数组,输入大小必须一致
+class Cascade_Predict(object):
+    output_results = True
+
+    def __init__(self, small_model, large_model, threshold=CASCADE_THRESHOLD, num_classes=n_class_file, mode=MODE):
+        if tuple(small_model.image_size) != tuple(large_model.image_size):
+            raise ValueError(f'小模型的输入{{small_model.image_size}}和大模型的输入{{large_model.image_size}}不一致')
+        self.small_model = small_model
+        self.large_model = large_model
+        self.threshold = threshold
+        self.num_classes = num_classes
+        self.mode = mode
+        self.image_size = large_model.image_size
+        self.image_number = 0
+        self.escalated_number = 0
+        self.small_time = 0
+        self.large_time = 0
+        self.lock = threading.Lock()
+
+    def decode(self, vectors):
+        return Predict_Image(mode=self.mode).decode_vectors(vectors=np.array(vectors), num_classes=self.num_classes)
+
+    def predict_results(self, images):
+        images = np.asarray(images)
+        start_time = time.perf_counter()
+        results = self.decode(self.small_model.predict_on_batch(images))
+        small_time = time.perf_counter() - start_time
+        escalated = [index for index, (result, recognition_rate) in enumerate(results) if
+                     recognition_rate is None or recognition_rate < self.threshold]
+        large_time = 0
+        if escalated:
+            start_time = time.perf_counter()
+            for index, result in zip(escalated, self.decode(self.large_model.predict_on_batch(images[escalated]))):
+                results[index] = result
+            large_time = time.perf_counter() - start_time
+        metrics.inc('captcha_cascade_images_total', {{'model': 'small'}}, len(images))
+        metrics.inc('captcha_cascade_images_total', {{'model': 'large'}}, len(escalated))
+        with self.lock:
+            self.image_number = self.image_number + len(images)
+            self.escalated_number = self.escalated_number + len(escalated)
+            self.small_time = self.small_time + small_time
+            self.large_time = self.large_time + large_time
+        return results
+
+    def report(self):
+        # 交给大模型的比例和每张图片的平均耗时(毫秒,包含解码结果)
+        image_number = max(self.image_number, 1)
+        return {{'threshold': self.threshold, 'image_number': self.image_number,
+                'escalated_number': self.escalated_number, 'escalated_rate': self.escalated_number / image_number,
+                'small_ms': self.small_time / image_number * 1000,
+                'large_ms': self.large_time / max(self.escalated_number, 1) * 1000,
+                'mean_ms': (self.small_time + self.large_time) / image_number * 1000}}
+
+
+# 过载保护丢弃的请求,后端返回503和对应的return_code
+class Request_Shed(Exception):
+    reason = None
+    return_code = None
+    return_info = None
+
+
+class Queue_Full(Request_Shed):
+    reason = 'queue_full'
+    return_code = '5005'
+    return_info = '服务繁忙，请稍后重试'
+
+
+class Deadline_Exceeded(Request_Shed):
+    reason = 'deadline'
+    return_code = '5006'
+    return_info = '请求超时，没有预测'
+
+
+def request_deadline(timeout=REQUEST_TIMEOUT):
+    # 把超时时间(秒)换算成time.perf_counter的截止时间,timeout为0或None时没有截止时间
+    return time.perf_counter() + timeout if timeout else None
+
+
+# Batch_Predict已经close之后还在用它预测,多模型服务里刚拿到的模型被其他线程淘汰时出现
+class Model_Closed(RuntimeError):
+    pass
+
+
+# 动态批处理,把并发请求合并成一个batch做一次前向计算,再把结果分发回各个请求
+# 队列里最多max_queue_size张图片,超出时直接拒绝;超过截止时间还没开始预测的图片直接丢弃
+class Batch_Predict(object):
+    def __init__(self, model, num_classes=n_class_file, max_batch_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT,
+                 mode=MODE, max_queue_size=QUEUE_MAX_SIZE):
+        self.model = model
+        self.num_classes = num_classes
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.mode = mode
+        self.max_queue_size = max_queue_size
+        # 模型的输入是否为图片原始字节(Serving_Predict),否则为decode_image处理后的数组
+        self.input_bytes = getattr(model, 'input_bytes', False)
+        self.image_size = getattr(model, 'image_size', (IMAGE_HEIGHT, IMAGE_WIDTH))
+        self.closed = False
+        self.queue = queue.Queue()
+        # /batch不经过队列直接预测的图片数,和队列里的图片一起算进max_queue_size
+        self.batch_pending = 0
+        self.batch_number = 0
+        self.image_number = 0
+        self.batch_size_count = collections.Counter()
+        self.shed_count = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, deadline=None):
+        self.admit(deadline)
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise Model_Closed('模型已经卸载')
+            self.queue.put((image, future, time.perf_counter(), deadline))
+        return future
+
+    def depth(self):
+        # 队列里的图片数加上/batch正在直接预测的图片数
+        return self.queue.qsize() + self.batch_pending
+
+    def admit(self, deadline=None, number=1):
+        # 再加上这次的number张图片超过max_queue_size时直接拒绝,已经超过截止时间时也直接拒绝,不再排队等模型
+        # 没有其他图片在等待时总是接收,超过max_queue_size的/batch请求也能处理
+        depth = self.depth()
+        if self.max_queue_size and depth and depth + number > self.max_queue_size:
+            raise self.shed(Queue_Full(f'等待批处理的图片已经有{{depth}}张'))
+        if deadline is not None and time.perf_counter() > deadline:
+            raise self.shed(Deadline_Exceeded('开始预测前已经超过截止时间'))
+
+    def shed(self, error):
+        # 记录被丢弃的请求,返回error
+        metrics.inc('captcha_shed_total', {{'reason': error.reason}})
+        with self.lock:
+            self.shed_count[error.reason] += 1
+        return error
+
+    def close(self):
+        # 处理完队列里已有的请求后结束批处理线程,之后的submit会报错
+        with self.lock:
+            self.closed = True
+            self.queue.put(None)
+
+    def decoder(self):
+        return Predict_Image(mode=self.mode, image_size=self.image_size)
+
+    def swap(self, model):
+        # 替换模型,之后的batch使用新模型,正在计算的batch继续用旧模型,返回旧模型
+        with self.lock:
+            model, self.model = self.model, model
+            self.image_size = getattr(self.model, 'image_size', (IMAGE_HEIGHT, IMAGE_WIDTH))
+        return model
+
+    def predict(self, image, deadline=None):
+        # image为decode_image处理后的(1, IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNALS)数组,input_bytes时为图片原始字节
+        return self.submit(image, deadline).result()
+
+    def predict_bytes(self, image, deadline=None):
+        # image为图片原始字节,按模型的输入决定是否先用decode_image解码,过载时不再解码
+        self.admit(deadline)
+        if not self.input_bytes:
+            image = self.decoder().timed_decode_image(image)
+            if image is None:
+                raise ValueError('图片解码失败')
+        return self.predict(image, deadline)
+
+    def submit_bytes(self, image, deadline=None):
+        # 不阻塞的predict_bytes,解码放到Predict_Image的线程池,解码完成后再进入批处理队列
+        if self.input_bytes:
+            return self.submit(image, deadline)
+        self.admit(deadline)
+        future = Future()
+
+        def decoded(decode_future):
+            try:
+                image = decode_future.result()
+                if image is None:
+                    raise ValueError('图片解码失败')
+                self.submit(image, deadline).add_done_callback(
+                    lambda predict_future: chain_future(predict_future, future))
+            except Exception as e:
+                future.set_exception(e)
+
+        Predict_Image.decode_executor.submit(self.decoder().timed_decode_image, image).add_done_callback(decoded)
+        return future
+
+    def collect(self):
+        # 阻塞等待第一个请求,之后最多等待max_wait秒或者凑够max_batch_size
+        items = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def run(self):
+        while True:
+            items = self.collect()
+            # None为close放进队列的结束标记
+            stop = None in items
+            items = [item for item in items if item is not None]
+            start_time = time.perf_counter()
+            for image, future, submit_time, deadline in items:
+                metrics.observe('captcha_stage_seconds', start_time - submit_time, {{'stage': 'queue_wait'}})
+                # 排队时已经超过截止时间的请求,客户端已经不再等待,不浪费模型的计算
+                if deadline is not None and start_time > deadline:
+                    future.set_exception(self.shed(Deadline_Exceeded('排队时已经超过截止时间')))
+            items = [item for item in items if not item[1].done()]
+            if items:
+                results = self.forward_safe([image for image, future, submit_time, deadline in items])
+                for (image, future, submit_time, deadline), result in zip(items, results):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+                self.record(len(items))
+            if stop:
+                if self.queue.empty():
+                    return
+                self.queue.put(None)
+
+    def stack(self, images):
+        if self.input_bytes:
+            return images
+        return np.concatenate(images, axis=0)
+
+    def forward(self, images):
+        # 整个batch只读取一次self.model,替换模型时不会一半用旧模型一半用新模型
+        model = self.model
+        images = self.stack(images)
+        with metrics.timer('forward'):
+            if getattr(model, 'output_results', False):
+                return model.predict_results(images)
+            vectors = model.predict_on_batch(images)
+        with metrics.timer('postprocess'):
+            return self.decoder().decode_vectors(vectors=np.array(vectors), num_classes=self.num_classes)
+
+    def forward_safe(self, images):
+        # 整个batch出错时逐张重试,只让出错的图片失败,出错的位置返回异常
+        try:
+            return self.forward(images)
+        except Exception as e:
+            logger.error(e)
+            if len(images) == 1:
+                return [e]
+        results = []
+        for image in images:
+            try:
+                results.extend(self.forward([image]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def predict_batch(self, images: list, deadline=None):
+        # 已经是一个完整的batch,不经过队列直接预测,预测期间这些图片也算进等待的图片数
+        self.admit(deadline, len(images))
+        with self.lock:
+            if self.closed:
+                raise Model_Closed('模型已经卸载')
+            self.batch_pending = self.batch_pending + len(images)
+        try:
+            results = self.forward_safe(images)
+        finally:
+            with self.lock:
+                self.batch_pending = self.batch_pending - len(images)
+        self.record(len(images))
+        return results
+
+    def record(self, batch_size):
+        metrics.observe('captcha_batch_size', batch_size)
+        with self.lock:
+            self.batch_number = self.batch_number + 1
+            self.image_number = self.image_number + batch_size
+            self.batch_size_count[batch_size] += 1
+            if self.batch_number % BATCH_REPORT_FREQ == 0:
+                logger.info(f'batch统计:{{self.report()}}')
+
+    def report(self):
+        # 已处理的batch数,图片数,平均batch大小,batch大小分布,队列中的图片数和过载保护丢弃的请求数
+        return {{'batch_number': self.batch_number, 'image_number': self.image_number,
+                'mean_batch_size': self.image_number / max(self.batch_number, 1),
+                'batch_size_count': dict(sorted(self.batch_size_count.items())),
+                'queue_size': self.queue.qsize(), 'batch_pending': self.batch_pending,
+                'shed_count': dict(self.shed_count)}}
+
+
+# 把source的结果或异常转给target
+def chain_future(source, target):
+    exception = source.exception()
+    if exception is not None:
+        target.set_exception(exception)
+    else:
+        target.set_result(source.result())
+
+
+# 识别结果缓存,以图片字节的哈希为键,带数量和过期时间限制的LRU
+# 相同图片的并发请求只做一次预测,其他请求等待这次的结果;backend为sqlite文件路径时多个后端进程共享缓存
+class Result_Cache(object):
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, backend=CACHE_BACKEND):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache = collections.OrderedDict()
+        self.flights = {{}}
+        self.lock = threading.Lock()
+        self.hit_number = 0
+        self.shared_hit_number = 0
+        self.coalesced_number = 0
+        self.miss_number = 0
+        # 每次clear加1,clear之前提交的预测结果不再写入缓存
+        self.generation = 0
+        self.connection = None
+        if backend and max_size:
+            self.connection = sqlite3.connect(backend, timeout=10, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                                    '(key TEXT PRIMARY KEY, result TEXT, recognition_rate REAL, expire REAL)')
+            self.connection.commit()
+            self.shared_lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.max_size)
+
+    @staticmethod
+    def key(image):
+        return hashlib.blake2b(image, digest_size=16).hexdigest()
+
+    def get_local(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            return None
+        expire, result = value
+        if expire < time.time():
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return result
+
+    def set_local(self, key, result):
+        with self.lock:
+            self.cache[key] = (time.time() + self.ttl, result)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def get_shared(self, key):
+        if self.connection is None:
+            return None
+        with self.shared_lock:
+            row = self.connection.execute('SELECT result, recognition_rate FROM cache WHERE key=? AND expire>?',
+                                          (key, time.time())).fetchone()
+        return tuple(row) if row else None
+
+    def set_shared(self, key, result):
+        if self.connection is None:
+            return None
+        with self.shared_lock:
+            self.connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                                    (key, str(result[0]), float(result[1]), time.time() + self.ttl))
+            if self.miss_number % 1000 == 0:
+                self.connection.execute('DELETE FROM cache WHERE expire<?', (time.time(),))
+            self.connection.commit()
+
+    def lookup(self, image):
+        # 只查缓存不预测,没有命中返回None
+        if not self:
+            return None
+        key = self.key(image)
+        with self.lock:
+            result = self.get_local(key)
+        if result is None:
+            result = self.get_shared(key)
+            if result is not None:
+                self.set_local(key, result)
+        with self.lock:
+            if result is None:
+                self.miss_number = self.miss_number + 1
+            else:
+                self.hit_number = self.hit_number + 1
+        return result
+
+    def store(self, image, result):
+        if not self:
+            return None
+        key = self.key(image)
+        self.set_local(key, result)
+        self.set_shared(key, result)
+
+    def get_or_submit(self, image, submit):
+        # image为图片原始字节,submit接收图片原始字节返回Future,不阻塞,返回的Future完成时为(结果,识别率)
+        if not self:
+            return submit(image)
+        key = self.key(image)
+        with self.lock:
+            result = self.get_local(key)
+            if result is not None:
+                self.hit_number = self.hit_number + 1
+                future = Future()
+                future.set_result(result)
+                return future
+            future = self.flights.get(key)
+            if future is not None:
+                self.coalesced_number = self.coalesced_number + 1
+                return future
+            future = Future()
+            self.flights[key] = future
+        try:
+            result = self.get_shared(key)
+            if result is not None:
+                with self.lock:
+                    self.shared_hit_number = self.shared_hit_number + 1
+                self.set_local(key, result)
+                self.finish(key, future, result=result)
+                return future
+            with self.lock:
+                self.miss_number = self.miss_number + 1
+            generation = self.generation
+            submit(image).add_done_callback(lambda predict_future: self.done(key, future, predict_future, generation))
+        except Exception as e:
+            self.finish(key, future, exception=e)
+        return future
+
+    def done(self, key, future, predict_future, generation=None):
+        exception = predict_future.exception()
+        if exception is not None:
+            return self.finish(key, future, exception=exception)
+        result = predict_future.result()
+        if generation is None or generation == self.generation:
+            self.set_local(key, result)
+            try:
+                self.set_shared(key, result)
+            except Exception as e:
+                logger.error(e)
+        self.finish(key, future, result=result)
+
+    def finish(self, key, future, result=None, exception=None):
+        with self.lock:
+            self.flights.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def clear(self):
+        # 换模型之后旧模型的识别结果作废
+        with self.lock:
+            self.generation = self.generation + 1
+            self.cache.clear()
+        if self.connection is not None:
+            with self.shared_lock:
+                self.connection.execute('DELETE FROM cache')
+                self.connection.commit()
+
+    def get_or_predict(self, image, predict):
+        # image为图片原始字节,predict接收图片原始字节返回(结果,识别率),在当前线程预测
+        def submit(image):
+            future = Future()
+            try:
+                future.set_result(predict(image))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        return self.get_or_submit(image, submit).result()
+
+    def report(self):
+        # 命中数(进程内/共享),合并的并发请求数,未命中数,命中率和当前缓存数量
+        total = self.hit_number + self.shared_hit_number + self.coalesced_number + self.miss_number
+        return {{'hit_number': self.hit_number, 'shared_hit_number': self.shared_hit_number,
+                'coalesced_number': self.coalesced_number, 'miss_number': self.miss_number,
+                'hit_rate': (total - self.miss_number) / max(total, 1), 'size': len(self.cache)}}
+
 
 def cheak_path(path):
     number = 0
@@ -1131,6 +3245,7 @@ import shutil
 from loguru import logger
 from {work_path}.{project_name}.settings import label_path
 from {work_path}.{project_name}.settings import App_model_path
+from {work_path}.{project_name}.settings import cascade_model_path
 from {work_path}.{project_name}.settings import checkpoint_path
 
 
@@ -1138,7 +3253,7 @@ def chrak_path():
     path = os.getcwd()
     paths = ['test_dataset', 'train_dataset', 'validation_dataset', 'train_enhance_dataset', 'train_pack_dataset',
              'validation_pack_dataset', 'test_pack_dataset', 'model', 'logs', 'CSVLogger', checkpoint_path,
-             label_path, App_model_path]
+             label_path, App_model_path, cascade_model_path]
     for i in paths:
         mix = os.path.join(path, i)
         if not os.path.exists(mix):
@@ -1184,7 +3299,9 @@ class DropBlock(tf.keras.layers.Layer):
         self.block_size = block_size
 
     def call(self, inputs, training=None):
-        # if training:
+        # 预测时不drop,直接返回输入
+        if not training:
+            return inputs
         '''
         feature map mask tensor
         創建一個均勻取樣的Tensor，加上drop rate之後取整數，則為1的部份表示drop block的中心點
@@ -2652,6 +4769,15 @@ class Models(object):
                       metrics=['acc'])
         return model
 
+    @staticmethod
+    def captcha_model_small():
+        # 级联预测的小模型,和captcha_model的输入输出一致
+        model = ShuffleNetV2.ShuffleNetV2(channel_scale=[48, 96, 192, 1024])
+        model.compile(optimizer=tf.keras.optimizers.Nadam(learning_rate=LR, beta_1=0.5, beta_2=0.9),
+                      loss=tf.keras.losses.CategoricalCrossentropy(label_smoothing=0.1),
+                      metrics=['acc'])
+        return model
+
     @staticmethod
     def captcha_model_num_classes():
         model = Densenet.Densenet_num_classes(num_init_features=64, growth_rate=32, block_layers=[6, 12, 64, 48],
@@ -2779,44 +4905,42 @@ from loguru import logger
 from {work_path}.{project_name}.settings import train_path
 from {work_path}.{project_name}.settings import validation_path
 from {work_path}.{project_name}.settings import test_path
-from {work_path}.{project_name}.settings import train_enhance_path
 from {work_path}.{project_name}.settings import DATA_ENHANCEMENT
+from {work_path}.{project_name}.settings import PACK_INCREMENTAL
 from {work_path}.{project_name}.settings import TFRecord_train_path
 from {work_path}.{project_name}.settings import TFRecord_validation_path
 from {work_path}.{project_name}.settings import TFRecord_test_path
 from {work_path}.{project_name}.utils import Image_Processing
 from {work_path}.{project_name}.utils import WriteTFRecord
-from concurrent.futures import ThreadPoolExecutor
 
-if DATA_ENHANCEMENT:
-    image_path = Image_Processing.extraction_image(train_path)
-    number = len(image_path)
-    with ThreadPoolExecutor(max_workers=100) as t:
-        for i in image_path:
-            number = number - 1
-            task = t.submit(Image_Processing.preprosess_save_images, i, number)
-    train_image = Image_Processing.extraction_image(train_enhance_path)
-    random.shuffle(train_image)
-
-else:
-    train_image = Image_Processing.extraction_image(train_path)
-    random.shuffle(train_image)
-validation_image = Image_Processing.extraction_image(validation_path)
-test_image = Image_Processing.extraction_image(test_path)
-
-Image_Processing.extraction_label(train_image + validation_image + test_image)
+# 打包使用多进程,必须放在__main__里
+if __name__ == '__main__':
+    if DATA_ENHANCEMENT:
+        # 只增强新增和修改的训练集图片,没有变化的图片沿用上次增强出的文件,增量打包时不会被当成新图片
+        train_image = Image_Processing.enhance_images(Image_Processing.extraction_image(train_path))
+        random.shuffle(train_image)
 
-train_lable = Image_Processing.extraction_label(train_image)
-validation_lable = Image_Processing.extraction_label(validation_image)
-test_lable = Image_Processing.extraction_label(test_image)
-# logger.debug(train_image)
-# logger.debug(train_lable)
-#
-with ThreadPoolExecutor(max_workers=3) as t:
-    t.submit(WriteTFRecord.WriteTFRecord, TFRecord_train_path, train_image, train_lable, 'train', 10000)
-    t.submit(WriteTFRecord.WriteTFRecord, TFRecord_validation_path, validation_image, validation_lable, 'validation',
-             10000)
-    t.submit(WriteTFRecord.WriteTFRecord, TFRecord_test_path, test_image, test_lable, 'test', 10000)
+    else:
+        train_image = Image_Processing.extraction_image(train_path)
+        random.shuffle(train_image)
+    validation_image = Image_Processing.extraction_image(validation_path)
+    test_image = Image_Processing.extraction_image(test_path)
+
+    # 映射表包含训练集、验证集和测试集的所有字符(类别),新的字符追加到末尾,已经打包的标签下标会改变时全部重新打包
+    vocabulary_changed = Image_Processing.update_vocabulary(train_image + validation_image + test_image)
+    incremental = PACK_INCREMENTAL and not vocabulary_changed
+
+    train_lable = Image_Processing.extraction_label(train_image)
+    validation_lable = Image_Processing.extraction_label(validation_image)
+    test_lable = Image_Processing.extraction_label(test_image)
+    # logger.debug(train_image)
+    # logger.debug(train_lable)
+    #
+    # 每个数据集都用满所有进程,依次打包
+    WriteTFRecord.WriteTFRecord(TFRecord_train_path, train_image, train_lable, 'train', incremental=incremental)
+    WriteTFRecord.WriteTFRecord(TFRecord_validation_path, validation_image, validation_lable, 'validation',
+                                incremental=incremental)
+    WriteTFRecord.WriteTFRecord(TFRecord_test_path, test_image, test_lable, 'test', incremental=incremental)
 
 """
 
@@ -2834,6 +4958,7 @@ Image_Processing.rename_suffix(Image_Processing.extraction_image(train_path))
 def save_model(work_path, project_name):
     return f"""import os
 import operator
+import numpy as np
 from loguru import logger
 from {work_path}.{project_name}.models import Models
 from {work_path}.{project_name}.callback import CallBack
@@ -2841,6 +4966,18 @@ from {work_path}.{project_name}.settings import MODEL
 from {work_path}.{project_name}.settings import MODEL_NAME
 from {work_path}.{project_name}.settings import model_path
 from {work_path}.{project_name}.settings import checkpoint_path
+from {work_path}.{project_name}.settings import serving_model_path
+from {work_path}.{project_name}.settings import n_class_file
+from {work_path}.{project_name}.settings import EXPORT_SERVING_MODEL
+from {work_path}.{project_name}.settings import EXPORT_POSTPROCESSING
+from {work_path}.{project_name}.settings import EXPORT_TFLITE
+from {work_path}.{project_name}.settings import OPTIMIZE_INFERENCE
+from {work_path}.{project_name}.settings import OPTIMIZE_TOLERANCE
+from {work_path}.{project_name}.utils import Serving_Model
+from {work_path}.{project_name}.utils import optimize_inference_model
+from {work_path}.{project_name}.utils import compare_inference_model
+from {work_path}.{project_name}.utils import convert_tflite
+from {work_path}.{project_name}.utils import tflite_file
 
 model = operator.methodcaller(MODEL)(Models)
 try:
@@ -2849,9 +4986,27 @@ try:
     model.load_weights(os.path.join(checkpoint_path, weight))
 except:
     raise OSError(f'没有任何的权重和模型在{{model_path}}')
+if OPTIMIZE_INFERENCE:
+    optimized = optimize_inference_model(model)
+    images = np.random.uniform(size=(8,) + tuple(model.input_shape[1:])).astype(np.float32)
+    report = compare_inference_model(model, optimized, images)
+    logger.info(f'最大误差为{{report["max_error"]}},CPU上单张耗时从{{report["latency_ms"]:.2f}}ms'
+                f'变为{{report["optimized_latency_ms"]:.2f}}ms')
+    if report['max_error'] <= OPTIMIZE_TOLERANCE:
+        model = optimized
+    else:
+        logger.warning(f'误差超过{{OPTIMIZE_TOLERANCE}},导出原模型')
 model_path = os.path.join(model_path, MODEL_NAME)
 model.save(model_path)
 logger.debug(f'{{model_path}}模型保存成功')
+if EXPORT_SERVING_MODEL:
+    Serving_Model(model, num_classes=n_class_file if EXPORT_POSTPROCESSING else None).save(serving_model_path)
+    logger.debug(f'{{serving_model_path}}服务模型导出成功')
+for quantization in EXPORT_TFLITE:
+    tflite_path = tflite_file(quantization)
+    with open(tflite_path, 'wb') as f:
+        f.write(convert_tflite(model, quantization))
+    logger.debug(f'{{tflite_path}}TFLite模型导出成功,大小为{{os.path.getsize(tflite_path) / 1024 / 1024:.2f}}MB')
 """
 
 
@@ -2863,8 +5018,17 @@ import datetime
 # 是否使用GPU
 USE_GPU = True
 
-# CPU的核心数，请根据自己的CPU来进行设置，正确选择核心数对训练有利
-CPU_NUMBER = 4
+# server.py多进程启动后端的进程数，所有进程共用5006端口
+WORKER_NUMBER = 4
+
+# 每个后端进程TensorFlow算子内部的线程数，0为分给这个进程的核心数
+INTRA_OP_THREADS = 0
+
+# 每个后端进程TensorFlow算子之间并行的线程数
+INTER_OP_THREADS = 1
+
+# 是否把每个后端进程绑定到分给它的CPU核心上
+CPU_AFFINITY = True
 
 # 模式选择 ORDINARY默认模式，需要设置验证码的长度 | NUM_CLASSES图片分类 | CTC识别文字，不需要文本设置长度
 MODE = 'ORDINARY'
@@ -2901,9 +5065,37 @@ IMAGE_CHANNALS = 3
 # 验证码的长度
 CAPTCHA_LENGTH = 8
 
+# CTC模式解码的beam宽度，1为贪心解码，大于1使用beam search(更准但更慢)
+CTC_BEAM_WIDTH = 1
+
 # 是否使用数据增强(数据集多的时候不需要用，接收一个整数，代表增强多少张图片)
 DATA_ENHANCEMENT = False
 
+# pack_dataset.py每个TFRecord分片的图片数
+PACK_SHARD_SIZE = 10000
+
+# pack_dataset.py并行打包的进程数，0为CPU的核心数
+PACK_WORKERS = 0
+
+# 打包的图片格式，'jpeg'(有损，最小) | 'png'(无损) | 'raw'(无损，填充后的uint8张量，训练时不用解码)，修改后需要重新打包
+PACK_FORMAT = 'jpeg'
+
+# pack_dataset.py是否增量打包，只编码新增和修改的图片，删除和修改的图片所在的分片重新编码，False时每次全部重新打包
+PACK_INCREMENTAL = True
+
+# 训练数据管道解码后的缓存，'memory'缓存在内存 | 'disk'缓存在dataset_cache文件夹 | None不缓存，每轮都重新读取和解码
+# 缓存时分片的顺序固定为第一轮的顺序，每轮只在SHUFFLE_BUFFER_SIZE条的缓冲区里打乱，需要更彻底的打乱时调大SHUFFLE_BUFFER_SIZE
+DATASET_CACHE = None
+
+# 训练集逐条打乱的缓冲区大小(条)
+SHUFFLE_BUFFER_SIZE = 10000
+
+# 同时读取的分片数
+INTERLEAVE_CYCLE = 4
+
+# 数据回显的倍数，训练受限于读取和解码时，每条解码后的数据重复使用几次，1为不回显
+DATA_ECHO = 1
+
 ## 模型设置
 # 定义模型的方法,模型在models.py定义
 MODEL = 'captcha_model'
@@ -2911,6 +5103,82 @@ MODEL = 'captcha_model'
 # 保存的模型名称
 MODEL_NAME = 'captcha.h5'
 
+# save_model.py是否导出只用于预测的模型(去掉噪声、dropout和DropBlock，把BatchNormalization折叠进卷积)
+OPTIMIZE_INFERENCE = False
+
+# 只用于预测的模型和原模型输出的最大允许误差，超出时仍导出原模型
+OPTIMIZE_TOLERANCE = 1e-3
+
+## 后端设置
+# 动态批处理的最大batch，并发请求会被合并成一个batch一起预测
+BATCH_MAX_SIZE = 32
+
+# 动态批处理凑batch的最长等待时间(秒)
+BATCH_MAX_WAIT = 0.005
+
+# 动态批处理队列最多排队的图片数，超出时直接返回503(return_code为5005)，0为不限制
+QUEUE_MAX_SIZE = 256
+
+# 请求的默认超时时间(秒)，客户端可以用timeout参数指定，超时还没开始预测的请求直接丢弃并返回503(return_code为5006)，0为不限制
+REQUEST_TIMEOUT = 3
+
+# 每处理多少个batch输出一次batch大小的统计
+BATCH_REPORT_FREQ = 1000
+
+# /batch接口并行解码图片的线程数
+DECODE_WORKERS = 4
+
+# 启动时预热的batch大小，预测时batch会向上补齐到最近的一个
+WARMUP_BATCH_SIZES = [1, 2, 4, 8, 16, 32]
+
+# save_model.py是否同时导出输入为图片原始字节的SavedModel(解码、缩放、填充、归一化都在计算图里)
+EXPORT_SERVING_MODEL = False
+
+# 导出SavedModel时是否把映射表和解码也写进计算图(直接输出识别结果和识别率)
+EXPORT_POSTPROCESSING = True
+
+# 后端是否使用上面导出的SavedModel，需要先运行save_model.py
+USE_SERVING_MODEL = False
+
+# save_model.py同时导出的TFLite模型，可选'float32'(不量化)、'float16'(半精度)、'int8'(动态范围量化)，[]为不导出
+EXPORT_TFLITE = []
+
+# 后端和test.py是否使用model文件夹里的TFLite模型，None为不使用，否则为使用哪种量化的TFLite模型，例如'float16'
+USE_TFLITE_MODEL = None
+
+# TFLite解释器池的大小，最多几个线程同时预测
+TFLITE_POOL_SIZE = 4
+
+# 每个TFLite解释器的线程数
+TFLITE_THREADS = 1
+
+# quantize.py从验证集取多少张图片校准全整数量化
+QUANTIZE_CALIBRATION_NUMBER = 200
+
+# quantize.py允许的最大准确率下降，全整数量化模型在测试集上的准确率下降不超过这个值时发布到App_model
+QUANTIZE_ACCURACY_BUDGET = 0.01
+
+# 识别结果缓存的数量(相同的图片直接返回上次的结果)，0为不使用缓存
+CACHE_SIZE = 10000
+
+# 识别结果缓存的过期时间(秒)
+CACHE_TTL = 3600
+
+# 多个后端进程共享缓存的sqlite文件路径，None为只使用进程内的缓存
+CACHE_BACKEND = None
+
+# 多模型服务(multi_app.py)常驻模型的总大小上限(MB)，超出时淘汰最久没有使用的模型
+MODEL_MEMORY_BUDGET = 2048
+
+# 后端是否使用级联预测，先用cascade_model里的小模型预测，识别率低的图片再交给App_model里的大模型，USE_SERVING_MODEL时不可用
+USE_CASCADE = False
+
+# 级联预测的阈值，小模型的识别率低于这个值时交给大模型，cascade.py可以评估不同阈值的效果
+CASCADE_THRESHOLD = 0.9
+
+# 每隔多少秒检查一次App_model(USE_SERVING_MODEL时为serving_model)，有新模型时在后台加载预热后替换，0为不检查
+RELOAD_INTERVAL = 10
+
 ## 路径设置，一般无需改动
 # 可视化配置batch或epoch
 UPDATE_FREQ = 'epoch'
@@ -2971,6 +5239,18 @@ test_pack_path = os.path.join(os.getcwd(), 'test_pack_dataset')
 # 提供后端放置的模型路径
 App_model_path = os.path.join(os.getcwd(), 'App_model')
 
+# 预处理写进计算图的SavedModel路径
+serving_model_path = os.path.join(os.getcwd(), 'serving_model')
+
+# 级联预测的小模型路径
+cascade_model_path = os.path.join(os.getcwd(), 'cascade_model')
+
+# 训练数据管道的磁盘缓存路径
+dataset_cache_path = os.path.join(os.getcwd(), 'dataset_cache')
+
+# 多模型服务的项目目录，默认为本项目的上一级目录
+projects_path = os.path.dirname(os.getcwd())
+
 # 映射表
 n_class_file = os.path.join(os.getcwd(), 'num_classes.json')
 """
@@ -2983,6 +5263,9 @@ import random
 import requests
 from loguru import logger
 
+# 上传方式 raw:直接上传图片字节(最省CPU) | file:multipart文件上传 | base64:base64后的表单
+UPLOAD = 'raw'
+
 
 def get_captcha():
     r = int(random.random() * 100000000)
@@ -3001,8 +5284,14 @@ if __name__ == '__main__':
         logger.info(f'获取验证码成功')
         with open(f'{{int(time.time())}}.jpg', 'wb') as f:
             f.write(content)
-        data = {{'img': base64.b64encode(content)}}
-        response = requests.post('http://127.0.0.1:5006', data=data)
+        if UPLOAD == 'raw':
+            response = requests.post('http://127.0.0.1:5006', data=content,
+                                     headers={{'Content-Type': 'application/octet-stream'}})
+        elif UPLOAD == 'file':
+            response = requests.post('http://127.0.0.1:5006', files={{'img': content}})
+        else:
+            data = {{'img': base64.b64encode(content)}}
+            response = requests.post('http://127.0.0.1:5006', data=data)
         logger.debug(response.json())
         if response.json().get('return_info') == '处理成功':
             logger.debug(f'验证码为{{response.json().get("result")}}')
@@ -3024,6 +5313,388 @@ Image_Processing.rename_path(train_image)
 """
 
 
+def benchmark(work_path, project_name):
+    return f"""# 压测后端: 按设定的并发数和请求速率把图片发给app.py,统计吞吐量、延迟分位数、错误率和识别准确率
+# 结果写入benchmark文件夹下的json,方便对比不同的模型和后端设置
+import os
+import re
+import json
+import time
+import base64
+import datetime
+import threading
+import collections
+import numpy as np
+import requests
+from loguru import logger
+from concurrent.futures import ThreadPoolExecutor
+from {work_path}.{project_name}.settings import test_path
+
+# 后端地址
+URL = 'http://127.0.0.1:5006'
+# 图片文件夹,文件名的第一个_之前为标签
+IMAGE_PATH = test_path
+# 并发数
+CONCURRENCY = 8
+# 每秒请求数,0为不限速(每个线程收到响应后立即发下一个请求)
+RATE = 0
+# 总请求数,0为每张图片请求一次,多于图片数时循环使用
+REQUEST_NUMBER = 0
+# 上传方式 raw | file | base64,和spider_example.py一致
+UPLOAD = 'raw'
+# 单个请求的超时时间(秒)
+TIMEOUT = 10
+# 结果保存的文件夹
+RESULT_PATH = os.path.join(os.getcwd(), 'benchmark')
+
+local = threading.local()
+
+
+def session():
+    # 每个线程一个Session,复用连接
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+
+def image_label(path):
+    # 和Predict_Image.decode_label一致,这里不导入utils,避免加载tensorflow
+    return re.split('_', os.path.splitext(os.path.split(path)[-1])[0])[0]
+
+
+def post(content):
+    if UPLOAD == 'raw':
+        return session().post(URL, data=content, headers={{'Content-Type': 'application/octet-stream'}},
+                              timeout=TIMEOUT)
+    elif UPLOAD == 'file':
+        return session().post(URL, files={{'img': content}}, timeout=TIMEOUT)
+    return session().post(URL, data={{'img': base64.b64encode(content)}}, timeout=TIMEOUT)
+
+
+def request(path, content, send_time=None):
+    # send_time为限速时这个请求应该发出的时间,延迟从这个时间算起,后端变慢时排队的时间也算在延迟里
+    if send_time is not None:
+        time.sleep(max(send_time - time.perf_counter(), 0))
+    start_time = send_time if send_time is not None else time.perf_counter()
+    result = {{'right': False, 'error': None}}
+    try:
+        response = post(content)
+        data = response.json()
+        if response.status_code != 200:
+            result['error'] = f'http_{{response.status_code}}'
+        elif data.get('return_info') != '处理成功':
+            result['error'] = f'{{data.get("return_code")}}:{{data.get("return_info")}}'
+        else:
+            result['right'] = str(data.get('result')) == image_label(path)
+    except Exception as e:
+        result['error'] = e.__class__.__name__
+    result['latency'] = time.perf_counter() - start_time
+    return result
+
+
+def summary(results, duration):
+    latency = np.array([result['latency'] for result in results]) * 1000
+    errors = collections.Counter(result['error'] for result in results if result['error'])
+    success_number = len(results) - sum(errors.values())
+    return {{
+        'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'url': URL, 'image_path': IMAGE_PATH,
+        'upload': UPLOAD, 'concurrency': CONCURRENCY, 'rate': RATE, 'request_number': len(results),
+        'duration': duration, 'throughput': len(results) / duration,
+        'latency_ms': {{'mean': float(np.mean(latency)), 'p50': float(np.percentile(latency, 50)),
+                       'p95': float(np.percentile(latency, 95)), 'p99': float(np.percentile(latency, 99)),
+                       'max': float(np.max(latency))}},
+        'error_rate': 1 - success_number / len(results), 'errors': dict(errors),
+        'accuracy': sum(result['right'] for result in results) / max(success_number, 1),
+    }}
+
+
+def main():
+    images = [os.path.join(IMAGE_PATH, i) for i in os.listdir(IMAGE_PATH)]
+    if not images:
+        raise OSError(f'{{IMAGE_PATH}}没有图片')
+    # 先把图片读进内存,压测时不读硬盘
+    contents = {{}}
+    for path in images:
+        with open(path, 'rb') as f:
+            contents[path] = f.read()
+    paths = [images[index % len(images)] for index in range(REQUEST_NUMBER or len(images))]
+    logger.info(f'开始压测{{URL}},共{{len(paths)}}个请求,并发数{{CONCURRENCY}},每秒请求数{{RATE or "不限"}}')
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        futures = [executor.submit(request, path, contents[path], start_time + index / RATE if RATE else None) for
+                   index, path in enumerate(paths)]
+        results = [future.result() for future in futures]
+    report = summary(results, time.perf_counter() - start_time)
+    logger.info(f'吞吐量{{report["throughput"]:.2f}}个/s,延迟p50 {{report["latency_ms"]["p50"]:.2f}}ms '
+                f'p95 {{report["latency_ms"]["p95"]:.2f}}ms p99 {{report["latency_ms"]["p99"]:.2f}}ms')
+    logger.info(f'错误率{{report["error_rate"] * 100:.2f}}% {{report["errors"]}},准确率{{report["accuracy"] * 100:.2f}}%')
+    os.makedirs(RESULT_PATH, exist_ok=True)
+    result_file = os.path.join(RESULT_PATH, f'benchmark-{{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}}.json')
+    with open(result_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    logger.info(f'结果保存在{{result_file}}')
+
+
+if __name__ == '__main__':
+    main()
+
+"""
+
+
+def benchmark_tfrecord(work_path, project_name):
+    return f"""# 对比三种打包格式: 从训练集随机取SAMPLE_NUMBER张图片,分别打包成jpeg、png和raw
+# 统计打包耗时、磁盘大小,以及逐条解析和先batch再批量解析的速度(条/秒),结果写入benchmark文件夹下的json
+import os
+import json
+import time
+import random
+import datetime
+import tempfile
+import tensorflow as tf
+from loguru import logger
+from {work_path}.{project_name}.settings import train_path
+from {work_path}.{project_name}.settings import BATCH_SIZE
+from {work_path}.{project_name}.utils import Image_Processing
+from {work_path}.{project_name}.utils import WriteTFRecord
+from {work_path}.{project_name}.utils import parse_function
+from {work_path}.{project_name}.utils import parse_batch_function
+from {work_path}.{project_name}.utils import vocabulary_size
+
+# 参与对比的图片数
+SAMPLE_NUMBER = 2000
+# 对比的打包格式
+FORMATS = ['jpeg', 'png', 'raw']
+# 每种格式解析几遍,取最快的一遍
+REPEAT = 3
+# 结果保存的文件夹
+RESULT_PATH = os.path.join(os.getcwd(), 'benchmark')
+
+# 对比的是CPU上的解析速度
+tf.config.experimental.set_visible_devices([], 'GPU')
+
+
+def parse_speed(dataset, number):
+    times = []
+    for _ in range(REPEAT):
+        start_time = time.perf_counter()
+        for _ in dataset:
+            pass
+        times.append(time.perf_counter() - start_time)
+    return number / min(times)
+
+
+def benchmark(image_format, images, labels, path, num_classes):
+    filename = os.path.join(path, f'{{image_format}}.tfrecords')
+    start_time = time.perf_counter()
+    WriteTFRecord.write_shard(filename, images, labels, image_format=image_format)
+    write_time = time.perf_counter() - start_time
+    records = tf.data.TFRecordDataset([filename])
+    per_record = records.map(
+        map_func=lambda exam_proto: parse_function(exam_proto, image_format=image_format, num_classes=num_classes),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(BATCH_SIZE)
+    batched = records.batch(BATCH_SIZE).map(
+        map_func=lambda exam_protos: parse_batch_function(exam_protos, image_format=image_format,
+                                                          num_classes=num_classes),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    size = os.path.getsize(filename)
+    return {{'format': image_format, 'write_seconds': write_time, 'size_mb': size / 1024 / 1024,
+            'bytes_per_record': size / len(images), 'records_per_second': parse_speed(per_record, len(images)),
+            'batched_records_per_second': parse_speed(batched, len(images))}}
+
+
+if __name__ == '__main__':
+    images = Image_Processing.extraction_image(train_path)
+    images = random.sample(images, min(SAMPLE_NUMBER, len(images)))
+    labels = Image_Processing.extraction_label(images)
+    with tempfile.TemporaryDirectory() as path:
+        results = [benchmark(image_format, images, labels, path, vocabulary_size()) for image_format in FORMATS]
+    for result in results:
+        logger.info(f'{{result["format"]:<5}} 打包{{result["write_seconds"]:.2f}}s 大小{{result["size_mb"]:.2f}}MB '
+                    f'每条{{result["bytes_per_record"]:.0f}}字节 逐条解析{{result["records_per_second"]:.0f}}条/秒 '
+                    f'批量解析{{result["batched_records_per_second"]:.0f}}条/秒')
+    os.makedirs(RESULT_PATH, exist_ok=True)
+    result_file = os.path.join(RESULT_PATH, f'tfrecord-{{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}}.json')
+    with open(result_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({{'sample_number': len(images), 'batch_size': BATCH_SIZE, 'results': results}},
+                           ensure_ascii=False, indent=2))
+    logger.info(f'结果已保存到{{result_file}}')
+
+"""
+
+
+def cascade(work_path, project_name):
+    return f"""# 级联预测的评估: 在测试集上对比只用小模型、只用大模型和不同阈值的级联预测
+# 输出交给大模型的比例、每张图片的平均耗时和准确率,用来选择CASCADE_THRESHOLD
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from loguru import logger
+from {work_path}.{project_name}.settings import n_class_file
+from {work_path}.{project_name}.settings import test_pack_path
+from {work_path}.{project_name}.settings import BATCH_MAX_SIZE
+from {work_path}.{project_name}.settings import CASCADE_THRESHOLD
+from {work_path}.{project_name}.serving import configure_device
+from {work_path}.{project_name}.serving import load_model_file
+from {work_path}.{project_name}.serving import app_model_path
+from {work_path}.{project_name}.serving import cascade_model_file
+from {work_path}.{project_name}.utils import tfrecord_files
+from {work_path}.{project_name}.utils import Cascade_Predict
+from {work_path}.{project_name}.utils import pack_parse_function
+from {work_path}.{project_name}.utils import label_text
+
+# 评估的阈值,CASCADE_THRESHOLD会自动加入
+THRESHOLDS = [0.5, 0.7, 0.8, 0.9, 0.95, 0.99]
+
+# 每次预测的batch大小,和后端动态批处理的最大batch一致
+BATCH_SIZE = BATCH_MAX_SIZE
+
+
+def evaluate(model, batches):
+    # 按batch预测,返回准确率和每张图片的平均耗时(毫秒)
+    right_number = 0
+    image_number = 0
+    start_time = time.perf_counter()
+    for images, labels in batches:
+        results = model.predict_results(images)
+        right_number = right_number + sum([str(result) == str(label) for (result, recognition_rate), label in
+                                           zip(results, labels)])
+        image_number = image_number + len(images)
+    return {{'accuracy': right_number / max(image_number, 1),
+            'mean_ms': (time.perf_counter() - start_time) / max(image_number, 1) * 1000}}
+
+
+if __name__ == '__main__':
+    configure_device()
+    with open(n_class_file, 'r', encoding='utf-8') as f:
+        num_classes = json.loads(f.read())
+    images = []
+    labels = []
+    for image, label in tf.data.TFRecordDataset(tfrecord_files(test_pack_path)).map(
+            map_func=pack_parse_function(test_pack_path)):
+        images.append(image.numpy())
+        labels.append(label_text(label, num_classes))
+    batches = [(np.stack(images[index:index + BATCH_SIZE]), labels[index:index + BATCH_SIZE]) for index in
+               range(0, len(images), BATCH_SIZE)]
+    logger.info(f'测试集共{{len(images)}}张图片')
+
+    small_model = load_model_file(cascade_model_file())
+    large_model = load_model_file(app_model_path())
+    # 阈值为负无穷时不会交给大模型,只用第一个模型预测
+    small_only = evaluate(Cascade_Predict(small_model, large_model, threshold=-np.inf), batches)
+    large_only = evaluate(Cascade_Predict(large_model, large_model, threshold=-np.inf), batches)
+    logger.info(f'只用小模型: 准确率{{small_only["accuracy"] * 100:.2f}}% 平均耗时{{small_only["mean_ms"]:.2f}}ms')
+    logger.info(f'只用大模型: 准确率{{large_only["accuracy"] * 100:.2f}}% 平均耗时{{large_only["mean_ms"]:.2f}}ms')
+    for threshold in sorted(set(THRESHOLDS + [CASCADE_THRESHOLD])):
+        cascade_predict = Cascade_Predict(small_model, large_model, threshold=threshold)
+        result = evaluate(cascade_predict, batches)
+        report = cascade_predict.report()
+        logger.info(f'阈值{{threshold}}: 交给大模型{{report["escalated_rate"] * 100:.2f}}% '
+                    f'准确率{{result["accuracy"] * 100:.2f}}% 平均耗时{{result["mean_ms"]:.2f}}ms')
+
+"""
+
+
+def quantize(work_path, project_name):
+    return f"""# 全整数量化: 用验证集校准,在测试集上和浮点模型对比准确率、模型大小和单张图片的CPU耗时
+# 准确率下降不超过QUANTIZE_ACCURACY_BUDGET时把量化模型发布到App_model
+import os
+import json
+import time
+import shutil
+import operator
+import numpy as np
+import tensorflow as tf
+from loguru import logger
+from {work_path}.{project_name}.models import Models
+from {work_path}.{project_name}.callback import CallBack
+from {work_path}.{project_name}.settings import MODE
+from {work_path}.{project_name}.settings import MODEL
+from {work_path}.{project_name}.settings import n_class_file
+from {work_path}.{project_name}.settings import checkpoint_path
+from {work_path}.{project_name}.settings import App_model_path
+from {work_path}.{project_name}.settings import validation_pack_path
+from {work_path}.{project_name}.settings import test_pack_path
+from {work_path}.{project_name}.settings import QUANTIZE_CALIBRATION_NUMBER
+from {work_path}.{project_name}.settings import QUANTIZE_ACCURACY_BUDGET
+from {work_path}.{project_name}.utils import tfrecord_files
+from {work_path}.{project_name}.utils import Predict_Image
+from {work_path}.{project_name}.utils import Inference_Model
+from {work_path}.{project_name}.utils import TFLite_Predict
+from {work_path}.{project_name}.utils import pack_parse_function
+from {work_path}.{project_name}.utils import label_text
+from {work_path}.{project_name}.utils import convert_tflite
+from {work_path}.{project_name}.utils import tflite_file
+
+# 对比的是CPU上的耗时
+tf.config.experimental.set_visible_devices([], 'GPU')
+
+
+def representative_dataset():
+    dataset = tf.data.TFRecordDataset(tfrecord_files(validation_pack_path)).map(
+        map_func=pack_parse_function(validation_pack_path)).take(QUANTIZE_CALIBRATION_NUMBER)
+    for image, label in dataset:
+        yield [tf.expand_dims(image, axis=0)]
+
+
+def evaluate(model, dataset, num_classes):
+    # 逐张预测,返回准确率和单张图片耗时的平均值、p50、p99(毫秒)
+    predict_image = Predict_Image(mode=MODE)
+    right_number = 0
+    times = []
+    for image, label in dataset:
+        image = image.numpy()[np.newaxis]
+        start_time = time.perf_counter()
+        vector = model.predict(image)
+        times.append((time.perf_counter() - start_time) * 1000)
+        text, recognition_rate = predict_image.decode_vectors(vectors=np.array(vector), num_classes=n_class_file)[0]
+        right_number = right_number + (str(text) == str(label_text(label, num_classes)))
+    return {{'accuracy': right_number / max(len(times), 1), 'mean_ms': float(np.mean(times)),
+            'p50_ms': float(np.percentile(times, 50)), 'p99_ms': float(np.percentile(times, 99))}}
+
+
+if __name__ == '__main__':
+    with open(n_class_file, 'r', encoding='utf-8') as f:
+        num_classes = json.loads(f.read())
+    weight = CallBack.calculate_the_best_weight()
+    if not weight:
+        raise OSError(f'没有任何的权重在{{checkpoint_path}}')
+    logger.info(f'读取的权重为{{weight}}')
+    model = operator.methodcaller(MODEL)(Models)
+    model.load_weights(os.path.join(checkpoint_path, weight))
+
+    float_path = tflite_file('float32')
+    with open(float_path, 'wb') as f:
+        f.write(convert_tflite(model, 'float32'))
+    quantize_path = tflite_file('full_int8')
+    with open(quantize_path, 'wb') as f:
+        f.write(convert_tflite(model, 'full_int8', representative_dataset=representative_dataset))
+    logger.debug(f'{{quantize_path}}全整数量化模型导出成功')
+
+    test_dataset = tf.data.TFRecordDataset(tfrecord_files(test_pack_path)).map(
+        map_func=pack_parse_function(test_pack_path))
+    report = {{
+        'keras': dict(evaluate(Inference_Model(model).warmup(), test_dataset, num_classes), size=None),
+        'float32': dict(evaluate(TFLite_Predict(float_path, pool_size=1).warmup(), test_dataset, num_classes),
+                        size=os.path.getsize(float_path)),
+        'full_int8': dict(evaluate(TFLite_Predict(quantize_path, pool_size=1).warmup(), test_dataset, num_classes),
+                          size=os.path.getsize(quantize_path)),
+    }}
+    for name, result in report.items():
+        size = f'{{result["size"] / 1024 / 1024:.2f}}MB' if result['size'] else '-'
+        logger.info(f'{{name:<10}} 准确率:{{result["accuracy"] * 100:.2f}}% 大小:{{size}} '
+                    f'单张耗时:平均{{result["mean_ms"]:.2f}}ms p50 {{result["p50_ms"]:.2f}}ms p99 {{result["p99_ms"]:.2f}}ms')
+    accuracy_loss = report['keras']['accuracy'] - report['full_int8']['accuracy']
+    logger.info(f'量化后准确率下降{{accuracy_loss * 100:.2f}}%,允许下降{{QUANTIZE_ACCURACY_BUDGET * 100:.2f}}%')
+    if accuracy_loss <= QUANTIZE_ACCURACY_BUDGET:
+        shutil.copy(quantize_path, App_model_path)
+        logger.info(f'量化模型已发布到{{App_model_path}}')
+    else:
+        logger.warning('准确率下降超出允许范围,没有发布量化模型')
+
+"""
+
+
 def test(work_path, project_name):
     return f"""import os
 import time
@@ -3036,11 +5707,15 @@ from {work_path}.{project_name}.settings import test_path
 from {work_path}.{project_name}.settings import model_path
 from {work_path}.{project_name}.settings import n_class_file
 from {work_path}.{project_name}.settings import MODEL_NAME
+from {work_path}.{project_name}.settings import USE_TFLITE_MODEL
 from {work_path}.{project_name}.models import CTCLoss
 from {work_path}.{project_name}.models import WordAccuracy
 from {work_path}.{project_name}.models import DropBlock
 from {work_path}.{project_name}.utils import Image_Processing
 from {work_path}.{project_name}.utils import Predict_Image
+from {work_path}.{project_name}.utils import Inference_Model
+from {work_path}.{project_name}.utils import TFLite_Predict
+from {work_path}.{project_name}.utils import tflite_file
 
 
 def running_time(time):
@@ -3081,15 +5756,19 @@ else:
 test_image_list = Image_Processing.extraction_image(test_path)
 random.shuffle(test_image_list)
 
-model_path = os.path.join(model_path, MODEL_NAME)
+model_path = tflite_file(USE_TFLITE_MODEL) if USE_TFLITE_MODEL else os.path.join(model_path, MODEL_NAME)
 logger.debug(f'加载模型{{model_path}}')
 if not os.path.exists(model_path):
     raise OSError(f'{{model_path}}没有模型')
 
-if MODE == 'CTC':
+if USE_TFLITE_MODEL:
+    model = TFLite_Predict(model_path).warmup()
+elif MODE == 'CTC':
     model = tf.keras.models.load_model(model_path, custom_objects={{'CTCLoss': CTCLoss, 'WordAccuracy': WordAccuracy}})
+    model = Inference_Model(model).warmup()
 else:
     model = tf.keras.models.load_model(model_path, custom_objects={{'DropBlock': DropBlock}})
+    model = Inference_Model(model).warmup()
 
 for i in test_image_list:
     Predict_Image(model=model, image=i, num_classes=n_class_file).predict_image()
@@ -3111,8 +5790,8 @@ from {work_path}.{project_name}.callback import CallBack
 from {work_path}.{project_name}.settings import MODEL
 from {work_path}.{project_name}.settings import EPOCHS
 from {work_path}.{project_name}.settings import USE_GPU
-from {work_path}.{project_name}.settings import CPU_NUMBER
 from {work_path}.{project_name}.settings import BATCH_SIZE
+from {work_path}.{project_name}.settings import DATA_ECHO
 from {work_path}.{project_name}.settings import model_path
 from {work_path}.{project_name}.settings import MODEL_NAME
 from {work_path}.{project_name}.settings import DATA_ENHANCEMENT
@@ -3122,8 +5801,8 @@ from {work_path}.{project_name}.settings import train_pack_path
 from {work_path}.{project_name}.settings import train_enhance_path
 from {work_path}.{project_name}.settings import validation_pack_path
 from {work_path}.{project_name}.utils import cheak_path
-from {work_path}.{project_name}.utils import parse_function
 from {work_path}.{project_name}.utils import Image_Processing
+from {work_path}.{project_name}.utils import build_dataset
 
 if USE_GPU:
     gpus = tf.config.experimental.list_physical_devices(device_type="GPU")
@@ -3149,22 +5828,18 @@ else:
     os.environ["CUDA_VISIBLE_DEVICE"] = "-1"
 
 with tf.device('/cpu:0'):
-    train_dataset = tf.data.TFRecordDataset(Image_Processing.extraction_image(train_pack_path)).map(
-        map_func=parse_function, num_parallel_calls=CPU_NUMBER).batch(batch_size=BATCH_SIZE).prefetch(
-        buffer_size=BATCH_SIZE)
+    train_dataset = build_dataset(train_pack_path)
     logger.debug(train_dataset)
-    validation_dataset = tf.data.TFRecordDataset(Image_Processing.extraction_image(validation_pack_path)).map(
-        map_func=parse_function, num_parallel_calls=CPU_NUMBER).batch(batch_size=BATCH_SIZE).prefetch(
-        buffer_size=BATCH_SIZE)
+    validation_dataset = build_dataset(validation_pack_path, training=False)
 
 model, c_callback = CallBack.callback(operator.methodcaller(MODEL)(Models))
 
 model.summary()
 
 if DATA_ENHANCEMENT:
-    logger.info(f'一共有{{int(len(Image_Processing.extraction_image(train_enhance_path)) / BATCH_SIZE)}}个batch')
+    logger.info(f'一共有{{int(len(Image_Processing.extraction_image(train_enhance_path)) * DATA_ECHO / BATCH_SIZE)}}个batch')
 else:
-    logger.info(f'一共有{{int(len(Image_Processing.extraction_image(train_path)) / BATCH_SIZE)}}个batch')
+    logger.info(f'一共有{{int(len(Image_Processing.extraction_image(train_path)) * DATA_ECHO / BATCH_SIZE)}}个batch')
 
 try:
     logs = pd.read_csv(csv_path)
@@ -3207,6 +5882,42 @@ class New_Work(object):
         with open(self.file_name('app.py'), 'w', encoding='utf-8') as f:
             f.write(app(self.work_parh, self.project_name))
 
+    def api_request(self):
+        with open(self.file_name('api_request.py'), 'w', encoding='utf-8') as f:
+            f.write(api_request(self.work_parh, self.project_name))
+
+    def serving(self):
+        with open(self.file_name('serving.py'), 'w', encoding='utf-8') as f:
+            f.write(serving(self.work_parh, self.project_name))
+
+    def asgi_app(self):
+        with open(self.file_name('asgi_app.py'), 'w', encoding='utf-8') as f:
+            f.write(asgi_app(self.work_parh, self.project_name))
+
+    def multi_app(self):
+        with open(self.file_name('multi_app.py'), 'w', encoding='utf-8') as f:
+            f.write(multi_app(self.work_parh, self.project_name))
+
+    def server(self):
+        with open(self.file_name('server.py'), 'w', encoding='utf-8') as f:
+            f.write(server(self.work_parh, self.project_name))
+
+    def benchmark(self):
+        with open(self.file_name('benchmark.py'), 'w', encoding='utf-8') as f:
+            f.write(benchmark(self.work_parh, self.project_name))
+
+    def quantize(self):
+        with open(self.file_name('quantize.py'), 'w', encoding='utf-8') as f:
+            f.write(quantize(self.work_parh, self.project_name))
+
+    def cascade(self):
+        with open(self.file_name('cascade.py'), 'w', encoding='utf-8') as f:
+            f.write(cascade(self.work_parh, self.project_name))
+
+    def benchmark_tfrecord(self):
+        with open(self.file_name('benchmark_tfrecord.py'), 'w', encoding='utf-8') as f:
+            f.write(benchmark_tfrecord(self.work_parh, self.project_name))
+
     def captcha_config(self):
         with open(self.file_name('captcha_config.json'), 'w') as f:
             f.write(captcha_config())
@@ -3274,6 +5985,15 @@ class New_Work(object):
     def main(self):
         self.callback()
         self.app()
+        self.api_request()
+        self.serving()
+        self.asgi_app()
+        self.multi_app()
+        self.server()
+        self.quantize()
+        self.cascade()
+        self.benchmark()
+        self.benchmark_tfrecord()
         self.captcha_config()
         self.check_file()
         self.delete_file()